@@ -14,6 +14,9 @@ byte serialBufferCount = 0;
 unsigned short expectingImageData = 0;
 unsigned short imageDataTargetX, imageDataTargetY, imageDataTargetWidth, imageDataCurrentY;
 
+//State while receiving binary LED data
+byte expectingLedData = 0;
+
 //Output an error message with index
 void printErrorWithIndex(const char * msg, byte i) {
   Serial.print("E: ");
@@ -295,6 +298,7 @@ void processInfoCommand() {
   Serial.println(DISP_H);
   Serial.print("ROT_CIRCLE_STEPS ");
   Serial.println(ROT_CIRCLE_STEPS);
+  Serial.println("LED_BIN 1");
   Serial.print("hasPartialUpdate: ");
   Serial.println(display.hasPartialUpdate);
   Serial.print("hasFastPartialUpdate: ");
@@ -314,6 +318,22 @@ void processLEDCommand() {
   leds.show();
 }
 
+void processBinaryLEDCommand() {
+  if (serialBufferCount < 3 || serialBuffer[1] != ' ' || atoi(serialBuffer + 2) != N_LED) {
+    Serial.println("E: Bad format.");
+    return;
+  }
+  //The command is followed by three raw bytes (R, G, B) per LED
+  expectingLedData = 3*N_LED;
+}
+
+void processBinaryLEDData() {
+  for (byte i = 0; i < N_LED; i++) {
+    leds.setPixelColor(i, (byte)serialBuffer[3*i], (byte)serialBuffer[3*i+1], (byte)serialBuffer[3*i+2]);
+  }
+  leds.show();
+}
+
 void processRefreshCommand() {
   if (serialBufferCount != 3 || serialBuffer[1] != ' ' || (serialBuffer[2] != 'p' && serialBuffer[2] != 'f' && serialBuffer[2] != 'o' && serialBuffer[2] != 'r')) {
     Serial.println("E: Bad format.");
@@ -415,7 +435,7 @@ void handleSerialInput() {
   if (Serial.available() > 0) {
     char c = Serial.read();
 
-    if (expectingImageData == 0 && c == '\n') {
+    if (expectingImageData == 0 && expectingLedData == 0 && c == '\n') {
       //Carriage return. Command ends and needs to be processed
       if (serialBufferCount == serialBufferSize) {
         Serial.println("E: Command too long.");
@@ -425,6 +445,9 @@ void handleSerialInput() {
           case 'A': //Assign buttons
             processAssignCommand();
             break;
+          case 'B': //Set LEDs from binary data
+            processBinaryLEDCommand();
+            break;
           case 'D':
             processDisplayCommand();
             break;
@@ -457,7 +480,13 @@ void handleSerialInput() {
         serialBuffer[serialBufferCount] = c;
         serialBufferCount++;
 
-        if (expectingImageData > 0) {
+        if (expectingLedData > 0) {
+          expectingLedData--;
+          if (expectingLedData == 0) {
+            processBinaryLEDData();
+            serialBufferCount = 0;
+          }
+        } else if (expectingImageData > 0) {
           expectingImageData--;
           if (serialBufferCount * 8 >= imageDataTargetWidth) {
             display.writeImage(serialBuffer, imageDataTargetX, imageDataCurrentY, imageDataTargetWidth, 1, false, false, false);
@@ -6,10 +6,12 @@ The logic of this is built around "modes", which are defined in "modes.py".
 Each mode can change key assignments, images, LED animations and their entire logic.
 """
 
+import asyncio
 import time
 import re
 import sys
 import traceback                # Print tracebacks if an error is thrown and caught
+from dataclasses import dataclass, field
 
 # pylint: disable=import-error
 from serial import SerialException
@@ -18,6 +20,7 @@ import serial.tools.list_ports  # Function to iterate over serial ports
 from inkkeys import Device
 from processchecks import get_active_processes, get_active_window
 import modes
+from modes import ModeBase
 from mqtt import InkkeysMqtt
 
 
@@ -32,6 +35,7 @@ DEBUG = True
 
 GET_ACTIVE_WINDOW_INTERVAL = 0.5
 GET_RUNNING_PROCESSES_INTERVAL = 5.0
+FRAME_INTERVAL = 1/30           # LED animation runs at up to 30 FPS
 
 
 print("https://there.oughta.be/a/macro-keyboard")
@@ -48,77 +52,136 @@ modes = [
             {"mode": modes.ModeZoom(), "activeWindow": re.compile(".*Zoom")},
             # {"mode": modes.ModeBlender(), "activeWindow": re.compile("^Blender")},
             {"mode": modes.ModeGimp(), "activeWindow": re.compile("^gimp.*")},
-            {"mode": modes.ModeFallback()}
+            {"mode": modes.ModeFallback(mqtt)}
         ]
 
 ##################################################################################################
 # Usually there should not be anything to be customized below this point
 ##################################################################################################
 
-def work():
+@dataclass
+class ControllerState:
     '''
-    Main loop of the program. This is where the magic happens.
+    State shared between the tasks of the main loop.
     '''
-    current_mode = None             # The current working mode
-    poll_interval = 0       # Polling interval as requested by the module
-    last_poll = 0           # Last time the poll function of the current mode was called
-    last_process_list = 0   # Last time the list of running processes was updated
-    last_mode_check = 0     # Last time a decision about the mode was made
-    active_window = None
-    mqtt.connect()        # Connect to the MQTT server (if used)
+    current_mode: ModeBase = None   # The current working mode
+    active_window: str = None       # Name of the last known active window
+    processes: frozenset = frozenset() # Names of the running processes, a new object only if they have changed
+    mode_changed: asyncio.Event = field(default_factory=asyncio.Event) # Set whenever a new mode is activated
+    matched_mode: dict = None       # Entry of the modes list matching the window and processes below
+    matched_window: str = None
+    matched_processes: frozenset = None
+
+def if_matching_mode(mode, state: ControllerState):
+    '''
+    Check if the given mode matches the current active window or running processes.
+    '''
+    return ("process" in mode and mode["process"] in state.processes) \
+        or ("activeWindow" in mode and mode["activeWindow"].match(state.active_window)) \
+        or not ("process" in mode or "activeWindow" in mode)
 
-    def if_matching_mode(mode):
-        return ("process" in mode and mode["process"] in processes) \
-            or ("activeWindow" in mode and mode["activeWindow"].match(active_window)) \
-            or not ("process" in mode or "activeWindow" in mode)
+async def update_mode(state: ControllerState):
+    '''
+    Check the active window and activate the first matching mode if it differs from the current one.
+    '''
+    window = get_active_window()
+    if window is not None:       # Ignore failures to get the active window fails.
+        if DEBUG and state.active_window != window:
+            print(f'Active window: {window}')
+        state.active_window = window
+    # Get the first mode that matches the current active window or running process.
+    # This only needs to be checked again if the window or the list of processes has changed.
+    if state.active_window != state.matched_window or state.processes is not state.matched_processes:
+        state.matched_mode = next(filter(lambda mode: if_matching_mode(mode, state), modes))
+        state.matched_window = state.active_window
+        state.matched_processes = state.processes
+    first_matching_mode = state.matched_mode
+    # Only take action if the mode is different from the current one
+    if first_matching_mode["mode"] != state.current_mode:
+        if DEBUG:
+            print(f'Switching from mode "{state.current_mode}" to: {first_matching_mode["mode"].__class__.__name__}')
+        # Send all the commands of the mode switch in as few writes as possible
+        with device.batch():
+            if state.current_mode is not None:
+                state.current_mode.deactivate(device)
+                device.send_led_animation(2, 50, 20, b=255, iteration=2)
+                await device.reset_display()
+            state.current_mode = first_matching_mode["mode"]
+            await state.current_mode.activate(device)
+        state.mode_changed.set()
+
+async def process_monitor(state: ControllerState):
+    '''
+    Regularly update the list of running processes.
+    '''
+    while True:
+        state.processes = get_active_processes()
+        await asyncio.sleep(GET_RUNNING_PROCESSES_INTERVAL)
 
-    try:
-        while True:
-            now = time.time() # Start time of this iteration
-
-            if now - last_process_list > GET_RUNNING_PROCESSES_INTERVAL:
-                processes = get_active_processes()
-                last_process_list = now
-
-            if now - last_mode_check > GET_ACTIVE_WINDOW_INTERVAL:
-                window = get_active_window()
-                if window is not None:       # Ignore failures to get the active window fails.
-                    if DEBUG and active_window != window:
-                        print(f'Active window: {window}')
-                    active_window = window
-                # Get the first mode that matches the current active window or running process
-                first_matching_mode = list(filter(if_matching_mode, modes))[0]
-                # Only take action if the mode is different from the current one
-                if first_matching_mode["mode"] != current_mode:
-                    if DEBUG:
-                        print(f'Switching from mode "{current_mode}" to: {first_matching_mode["mode"].__class__.__name__}')
-                    if current_mode is not None:
-                        current_mode.deactivate(device)
-                        device.send_led_animation(2, 50, 20, b=255, iteration=2)
-                        device.reset_display()
-                    current_mode = first_matching_mode["mode"]
-                    current_mode.activate(device)
-                    poll_interval = 0
-                last_mode_check = now
-
-            # Regularly call the poll function of the mode if it requires regular polling
-            if poll_interval is not False and now - last_poll > poll_interval >= 0:
-                poll_interval = current_mode.poll(device)
-                last_poll = now
-
-            # Animate the LEDs and update the display
-            current_mode.animate(device)
-            # Check for key presses and call the corresponding callback functions
-            device.poll()
-
-            # Sleep until 1/30 sec have passed as there is no need to exceed 30 FPS
-            time_to_30_fps = time.time() - now + 0.0333
-            if time_to_30_fps > 0:
-                time.sleep(time_to_30_fps)
+async def window_monitor(state: ControllerState):
+    '''
+    Regularly check the active window and switch modes accordingly.
+    '''
+    while True:
+        await update_mode(state)
+        await asyncio.sleep(GET_ACTIVE_WINDOW_INTERVAL)
 
-    except KeyboardInterrupt:
+async def mode_poller(state: ControllerState):
+    '''
+    Call the poll function of the current mode as often as it requests.
+    A mode switch triggers an immediate poll of the new mode.
+    '''
+    while True:
+        state.mode_changed.clear()
+        poll_interval = await state.current_mode.poll(device)
+        try:
+            if poll_interval is False or poll_interval < 0:
+                # No polling required until the mode changes
+                await state.mode_changed.wait()
+            else:
+                await asyncio.wait_for(state.mode_changed.wait(), poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def animator(state: ControllerState):
+    '''
+    Animate the LEDs and update the display. There is no need to exceed 30 FPS.
+    '''
+    loop = asyncio.get_running_loop()
+    next_frame = loop.time()    # The loop clock is monotonic and does not jump with the wall clock
+    while True:
+        state.current_mode.animate(device)
+        # Schedule frames at fixed intervals so the time spent animating does not add up as drift
+        next_frame += FRAME_INTERVAL
+        delay = next_frame - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            # Running late, drop the missed frames instead of trying to catch up
+            next_frame = loop.time()
+            await asyncio.sleep(0)
+
+async def work():
+    '''
+    Main loop of the program. This is where the magic happens.
+    Each task runs at its own rate and the event loop idles in between.
+    '''
+    state = ControllerState()
+    mqtt.connect()        # Connect to the MQTT server (if used)
+    try:
+        # Make sure that a mode is active before the tasks start relying on it
+        state.processes = get_active_processes()
+        await update_mode(state)
+        # Key presses are dispatched by the device as they arrive, so we only need to watch the connection
+        await asyncio.gather(
+            process_monitor(state),
+            window_monitor(state),
+            mode_poller(state),
+            animator(state),
+            device.wait_disconnected(),
+        )
+    finally:
         mqtt.disconnect()
-        print('Disconnected from device. Hit Ctrl+c again to quit before reconnect.')
 
 def is_port_matches(tested_port):
     '''
@@ -126,16 +189,28 @@ def is_port_matches(tested_port):
     '''
     return tested_port.vid == VID and tested_port.pid == PID
 
+async def use_port(port):
+    '''
+    Connect to the device on the given port and enter the main loop if successful.
+    '''
+    if not await device.connect(port):
+        return False
+    try:
+        await work()  # Success, enter main loop
+    finally:
+        device.disconnect()
+    return True
+
 def try_using_port(port):
     '''
     Try to connect to the device on the given port. If successful, enter the main loop.
     Return False if the connection fails or the device is not the correct one.
     '''
     try:
-        if device.connect(port):
-            work()  # Success, enter main loop
-            device.disconnect()
-            return True
+        return asyncio.run(use_port(port))
+    except KeyboardInterrupt:
+        print('Disconnected from device. Hit Ctrl+c again to quit before reconnect.')
+        return True
     except SerialException as serial_error:
         print("Serial error: ", serial_error)
     except Exception:
@@ -149,8 +224,6 @@ def try_using_port(port):
 device = Device()
 device.debug = DEBUG
 
-work()
-
 def main():
     '''
     Main function that tries to connect to the device and restarts the connection if it fails.
@@ -160,9 +233,8 @@ def main():
             if SERIALPORT is not None:
                 try_using_port(SERIALPORT)
             else:
-                matching_ports = list(filter(is_port_matches, serial.tools.list_ports.comports()))
                 # Iterate over all matching serial ports
-                for port in matching_ports:
+                for port in filter(is_port_matches, serial.tools.list_ports.comports()):
                     # Try connecting to this device
                     if try_using_port(port.device):
                         ## When the program reaches this point it means a successful connection
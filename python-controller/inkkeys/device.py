@@ -1,16 +1,172 @@
 #!/usr/bin/env python3
 
+import asyncio
 import time
 import io
-from threading import Lock
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
+import numpy as np
 from PIL import Image, ImageDraw, ImageOps, ImageFont
 # pylint: disable=import-error
-from serial import Serial, SerialException  # Serial functions
+from serial import SerialException          # Serial functions
+import serial_asyncio                       # Asyncio serial transport, pip3 install pyserial-asyncio
 
 from .protocol import *
 
-CHUNK_SIZE = 100
+# Prefixes of the commands sent most often, encoded only once
+_CMD_DISPLAY = (CommandCode.DISPLAY.value + " ").encode('ascii')
+_CMD_LED = (CommandCode.LED.value + " ").encode('ascii')
+_CMD_LED_BIN = (CommandCode.LED_BIN.value + " ").encode('ascii')
+
+# Messages sent by the device when a key is pressed or released
+KEY_EVENTS = {key.value for key in KeyCode if key not in (KeyCode.JOG, KeyCode.JOG_CW, KeyCode.JOG_CCW)}
+
+def pack_image(image):
+    '''
+    Convert an image into the 1 bit per pixel format of the display, rotated by 180 degrees.
+    Images which are not already black and white are thresholded instead of dithered.
+    '''
+    if image.mode == "1":
+        pixels = np.asarray(image, dtype=np.uint8)
+    else:
+        pixels = np.asarray(image.convert("L")) > 127
+    # Flipping both axes is a rotation by 180 degrees, each row is padded to a full byte like PIL does
+    return np.packbits(pixels[::-1, ::-1], axis=1).tobytes()
+
+@lru_cache(maxsize=16)
+def _font(path, size):
+    '''
+    Load a font only once, parsing the file is expensive.
+    '''
+    return ImageFont.truetype(path, size)
+
+@lru_cache(maxsize=16)
+def _marker(path):
+    '''
+    Load a marker image together with the mask used to paste it.
+    '''
+    marker = Image.open(path)
+    marker.load()
+    return marker, ImageOps.invert(marker.convert("RGB")).convert("1")
+
+@lru_cache(maxsize=128)
+def _icon_image(icon, w, h, left, inverted, centered, marked, crossed):
+    '''
+    Draw an icon into an area of the given size and return the packed image data.
+    "left" tells if the area is on the left side of the display (functions 2 to 5).
+    Modes draw the same few icons over and over again, so the result is cached.
+    '''
+    img = Image.new("1", (w, h), color=(0 if inverted else 1))
+    imgIcon = Image.open(icon).convert("RGB")
+    if inverted:
+        imgIcon = ImageOps.invert(imgIcon)
+    wi, hi = imgIcon.size
+    if left:
+        pos = ((w-wi)//2 if centered else 0, (h - hi)//2)
+    else:
+        pos = ((w-wi)//2 if centered else (w - wi), (h - hi)//2)
+    img.paste(imgIcon, pos)
+
+    if marked:
+        imgMarker, maskMarker = _marker("icons/chevron-compact-right.png" if left else "icons/chevron-compact-left.png")
+        wm, hm = imgMarker.size
+        img.paste(imgMarker, (-16,(h - hm)//2) if left else (w-wm+16,(h - hm)//2), mask=maskMarker)
+
+    if crossed:
+        d = ImageDraw.Draw(img)
+        d.line([pos[0]+5, pos[1]+5, pos[0]+wi-5, pos[1]+hi-5], width=3)
+        d.line([pos[0]+5, pos[1]+hi-5, pos[0]+wi-5, pos[1]+5], width=3)
+
+    return pack_image(img)
+
+@lru_cache(maxsize=32)
+def _area_for(function, display_width, display_height, banner_height, debug):
+    '''
+    Calculate the area of the screen for a function. The result only depends on the arguments, so it is cached.
+    '''
+    banner_space = banner_height//2  # Each side gives space for half the banner height
+    tile_height = display_height//4               # Tile height is the screen height divided by 4
+    tile_width = (display_width//2)-banner_space # Tile width is half the screen minus half the banner height
+
+    if function == "title":
+        # TODO: The controler hangs and fails to upddate the display when the title is less than 40 in height
+        area = (tile_width, 0, 40, display_height)
+    elif function == 1:
+        # TODO: Decide what to do with button 1 text, if anything.
+        area = (0, tile_width, display_height, display_width//2+banner_height)
+    elif function <= 5:
+        area = (tile_width+(banner_height), (5-function)*tile_height, tile_width+2, tile_height)
+    else:
+        area = (0, (9-function)*tile_height, tile_width+2, tile_height)
+
+    if debug:
+        # Only printed the first time, afterwards the area comes from the cache
+        x, y, w, h = area
+        print(f'Area for {function} is {x}/{y} {w}x{h}')
+    return area
+
+def areas_overlap(a, b):
+    '''
+    Check if two areas given as (x, y, w, h) overlap.
+    '''
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    return ax < bx+bw and bx < ax+aw and ay < by+bh and by < ay+ah
+
+def led_channels(leds):
+    '''
+    Split a list of 0xRRGGBB colors into an array with one row of R, G and B bytes per LED.
+    '''
+    return np.array(leds, dtype='>u4').view(np.uint8).reshape(-1, 4)[:, 1:].copy()
+
+def led_hex(channels):
+    '''
+    Format LED channels (one row of R, G and B per LED) as the hex strings expected by the LED command.
+    '''
+    hexstr = channels.tobytes().hex()
+    return [hexstr[i:i+6] for i in range(0, len(hexstr), 6)]
+
+def is_jog_event(line):
+    '''
+    Check if the line reports a rotation of the jog dial (i.e. "R3" or "R-1").
+    '''
+    return line[:1] == KeyCode.JOG.value and (line[1:].isdecimal() or (line[1:2] == '-' and line[2:].isdecimal()))
+
+def report_exception(future):
+    '''
+    Print the traceback of an exception raised by a task or future nobody waits for.
+    Meant to be added as a done callback.
+    '''
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+class DeviceProtocol(asyncio.Protocol):
+    '''
+    Receives the data from the device and splits it into lines, which are handed to the device.
+    '''
+    def __init__(self, device):
+        self.device = device
+        self.inbuffer = bytearray()
+
+    def data_received(self, data):
+        # Whatever is left in the buffer is an incomplete line, so only the new data has to be searched
+        searched = len(self.inbuffer)
+        self.inbuffer += data
+        start = 0
+        end = self.inbuffer.find(b'\n', searched)
+        while end >= 0:
+            self.device.line_received(self.inbuffer[start:end].decode('ISO-8859-16').replace('\r', ''))
+            start = end + 1
+            end = self.inbuffer.find(b'\n', start)
+        # Drop all complete lines at once
+        del self.inbuffer[:start]
+
+    def connection_lost(self, exc):
+        self.device.connection_lost(exc)
 
 class Device:
     def __init__(self):
@@ -18,27 +174,51 @@ class Device:
         self.testmode = False
 
         self.ser = None
-        self.inbuffer = ""
-        self.awaiting_response_lock = Lock()
+        self._transport = None
+        self._protocol = None
+        self._disconnected = None
+        self._request_lock = None       # Only one request can wait for its response at a time
+        self._pending_response = None   # Future resolved once the response to the last request is complete
+        self._response_lines = []       # Lines of the response received so far
+        self._response_end = None       # Last line of the expected response
+        self._batch = None              # Collects the data written during a batch, see batch()
         self.num_of_leds = 0
         self.display_width = 0
         self.display_height = 0
         self.rotation_factor = 0
         self.rotation_circle_steps = 0
+        self.has_binary_leds = False    # Firmware accepts raw LED data (LED_BIN command)
         self.banner_height = 20  # Defines the height of top and bottom banner
         self.image_buffer = []
+        self.sent_images = {}   # Packed image data currently shown in each area of the display
+        # Images are drawn in a single separate thread, which keeps them in order and never uses a font from two threads
+        self._renderer = ThreadPoolExecutor(max_workers=1)
         self.callbacks = {}     # Stores callback functions that react directly to a keypress reported via serial
+        self._callback_tasks = set()    # Keeps a reference to callbacks which are still running
         self.led_state = None
         self.led_set_time = None
+        self.led_fade_level = None  # Fixed point brightness (0-256) last sent by fade_leds
+        self.last_led_colors = None # LED data last sent to the device, used to skip sending the same colors again
         self.status = False
 
-    def connect(self, dev):
+    async def connect(self, dev):
         '''
         Connect to the device on the given port.
         '''
         print(f'Connecting to {dev}.')
-        self.ser = Serial(dev, 115200, timeout=1, write_timeout=5)
-        if not self.request_info(3):
+        loop = asyncio.get_running_loop()
+        self._pending_response = None
+        self._request_lock = asyncio.Lock()
+        self._disconnected = loop.create_future()
+        self.last_led_colors = None
+        self.sent_images = {}
+        self._batch = None
+        self.has_binary_leds = False
+        self._protocol = DeviceProtocol(self)
+        self._transport, _ = await serial_asyncio.create_serial_connection(loop, lambda: self._protocol, dev, 115200)
+        self.ser = self._transport.serial
+        self.enable_low_latency()
+        if not await self.request_info(3):
             self.disconnect()
             return False
         if self.testmode:
@@ -47,55 +227,139 @@ class Device:
         print(f'Connected to {self.ser.name}.')
         return True
 
+    def enable_low_latency(self):
+        '''
+        Ask the serial driver to hand over received data immediately instead of buffering it.
+        This is only supported on POSIX systems and not by every driver, so failing is fine.
+        '''
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (AttributeError, IOError, NotImplementedError) as e:
+            if self.debug:
+                print(f'Low latency mode not available: {e}')
+
     def disconnect(self):
-        if self.ser is not None:
-            self.ser.close()
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
             self.ser = None
 
+    async def wait_disconnected(self):
+        '''
+        Wait until the connection to the device is lost.
+        Raises a SerialException if the connection was closed due to an error.
+        '''
+        await self._disconnected
+
+    def connection_lost(self, exc):
+        if not self._disconnected.done():
+            if exc is None:
+                self._disconnected.set_result(None)
+            else:
+                self._disconnected.set_exception(SerialException(exc))
+
+    def write(self, data):
+        '''
+        Write data to the device, or add it to the current batch.
+        '''
+        if self._batch is not None:
+            self._batch += data
+        else:
+            self._transport.write(data)
+
+    def flush_batch(self):
+        '''
+        Write everything collected in the current batch to the device right away.
+        '''
+        if self._batch:
+            if self.debug:
+                print(f'Sending batch of {len(self._batch)} bytes.')
+            self._transport.write(bytes(self._batch))
+            self._batch.clear()
+
+    @contextmanager
+    def batch(self):
+        '''
+        Collect all commands sent within the with block and write them in one go at its end.
+        Requests, which need to wait for a response, write the batch collected so far first.
+        '''
+        if self._batch is not None:     # Already batching, the outermost batch writes the data
+            yield
+            return
+        self._batch = bytearray()
+        try:
+            yield
+        finally:
+            if self._transport is not None:
+                self.flush_batch()
+            self._batch = None
+
     def send_to_device(self, command: str):
         if self.debug:
             print(f'Sending: {command}')
-        self.ser.write((command + "\n").encode())
+        self.write((command + "\n").encode())
 
     def send_binary_to_device(self, data):
         if self.debug:
             print(f'Sending {len(data)} bytes of binary data.')
-        try:
-            # Send binary data in chunks to prevent killing the serial connection
-            endIx = CHUNK_SIZE
-            startIx = 0
-            while startIx < len(data):
-                self.ser.write(data[startIx:endIx])
-                #if self.debug:
-                #    print(data[startIx:endIx].hex())
-                startIx = startIx + CHUNK_SIZE
-                endIx = endIx + CHUNK_SIZE
-            if self.debug:
-                print('Data sent.')
-        except SerialException as e:
-            print("Serial error: ", e)
-
-    def read_from_device(self):
-        if self.ser.in_waiting > 0:
-            self.inbuffer += self.ser.read(self.ser.in_waiting).decode('ISO-8859-16').replace('\r', '')
-        chunks = self.inbuffer.split("\n", 1)
-        if len(chunks) > 1:
-            cmd = chunks[0]
-            self.inbuffer = chunks[1]
-            if self.debug:
-                print(f'Received: {cmd}')
-            return cmd
-        return None
-
-    def poll(self):
-        with self.awaiting_response_lock:
-            input = self.read_from_device()
-        if input is not None:
-            if input[0] == KeyCode.JOG.value and (input[1:].isdecimal() or (input[1] == '-' and input[2:].isdecimal())):
-                if KeyCode.JOG.value in self.callbacks:
-                    self.callbacks[KeyCode.JOG.value](int(input[1:]))
-            elif input in self.callbacks:
-                self.callbacks[input]()
+        # The transport buffers the data and passes it on as fast as the port accepts it
+        self.write(data)
+
+    def line_received(self, line):
+        '''
+        Called for each line received from the device.
+        Key events are dispatched to the callbacks right away, anything else is queued as a response.
+        '''
+        if self.debug:
+            print(f'Received: {line}')
+        if is_jog_event(line):
+            if KeyCode.JOG.value in self.callbacks:
+                self.run_callback(self.callbacks[KeyCode.JOG.value], int(line[1:]))
+        elif line in KEY_EVENTS:
+            if line in self.callbacks:
+                self.run_callback(self.callbacks[line])
+        else:
+            self.response_received(line)
+
+    def response_received(self, line):
+        '''
+        Collect the lines of the response to a request and resolve the request once the last line arrives.
+        Lines received while no request is pending are ignored.
+        '''
+        if self._pending_response is None or self._pending_response.done():
+            return
+        self._response_lines.append(line)
+        if line == self._response_end:
+            self._pending_response.set_result(self._response_lines)
+
+    def run_callback(self, cb, *args):
+        '''
+        Call a callback function. If it is a coroutine function, it is scheduled as a task on the event loop.
+        '''
+        result = cb(*args)
+        if asyncio.iscoroutine(result):
+            task = asyncio.ensure_future(result)
+            self._callback_tasks.add(task)
+            task.add_done_callback(self._callback_tasks.discard)
+            task.add_done_callback(report_exception)
+
+    async def request(self, command, response_end, timeout):
+        '''
+        Send a command and wait until the device answers with the line "response_end".
+        Returns all lines of the response or None if it was not complete before the timeout.
+        '''
+        async with self._request_lock:
+            self._response_lines = []
+            self._response_end = response_end
+            self._pending_response = asyncio.get_running_loop().create_future()
+            self.send_to_device(command)
+            self.flush_batch()      # The device cannot answer a command that is still in the batch
+            try:
+                return await asyncio.wait_for(self._pending_response, timeout)
+            except asyncio.TimeoutError:
+                return None
+            finally:
+                self._pending_response = None
 
     def register_callback(self, cb, key):
         self.callbacks[key.value] = cb
@@ -105,61 +369,81 @@ class Device:
             del self.callbacks[key.value]
 
     def clear_callbacks(self):
+        '''
+        Remove all callbacks and cancel those still running, so they cannot act on the next mode.
+        '''
         self.callbacks = {}
+        for task in self._callback_tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
 
     def assign_key(self, key, sequence):
-        self.send_to_device(CommandCode.ASSIGN.value + " " + key.value + (" " + " ".join(sequence) if len(sequence) > 0 else ""))
+        self.send_to_device(" ".join((CommandCode.ASSIGN.value, key.value, *sequence)))
 
     def send_led(self, colors):
-        self.send_to_device(CommandCode.LED.value + " " + " ".join(colors))
+        colors = " ".join(colors)
+        if self.debug:
+            print(f'Sending: {CommandCode.LED.value} {colors}')
+        self.write(_CMD_LED + colors.encode('ascii') + b"\n")
+
+    def send_led_binary(self, data):
+        '''
+        Send the raw R, G and B bytes of all LEDs in a single frame.
+        '''
+        if self.debug:
+            print(f'Sending {len(data)} bytes of LED data.')
+        self.write(_CMD_LED_BIN + b"%d\n" % (len(data)//3) + data)
+
+    def update_leds(self, channels):
+        '''
+        Send the LED channels unless they are identical to the ones sent last.
+        Older firmware without support for binary LED data gets the colors as hex strings.
+        '''
+        data = channels.tobytes()
+        if data == self.last_led_colors:
+            return
+        self.last_led_colors = data
+        if self.has_binary_leds:
+            self.send_led_binary(data)
+        else:
+            self.send_led(led_hex(channels))
 
     def send_led_animation(self, animation, steps, delay=0, brightness=0, r=0, g=0, b=0, iteration=1):
+        self.last_led_colors = None # The animation leaves the LEDs in an unknown state
         self.send_to_device(f"{CommandCode.ANIMATE.value} {animation} {steps} {delay} {brightness} {r} {g} {b} {iteration}")
 
-    def request_info(self, timeout):
-        with self.awaiting_response_lock:
-            print('Requesting device info...')
-            start = time.time()
-            self.send_to_device(CommandCode.INFO.value)
-            line = self.read_from_device()
-            while line != "Inkkeys":
-                if time.time() - start > timeout:
-                    return False
-                if line is None:
-                    time.sleep(0.1)
-                    line = self.read_from_device()
-                    continue
+    async def request_info(self, timeout):
+        print('Requesting device info...')
+        lines = await self.request(CommandCode.INFO.value, 'Done', timeout)
+        if lines is None or "Inkkeys" not in lines:
+            return False
+        header = lines.index("Inkkeys")
+        for line in lines[:header]:
+            print(f'Skipping: {line}')
+        print('Header found. Reading infos...')
+        for line in lines[header+1:-1]:
+            if line.startswith('TEST '):
+                self.testmode = line[5] != '0'
+            elif line.startswith('N_LED '):
+                self.num_of_leds = int(line[6:])
+            elif line.startswith('DISP_W '):
+                self.display_width = int(line[7:])
+            elif line.startswith('DISP_H '):
+                self.display_height = int(line[7:])
+            elif line.startswith('ROT_CIRCLE_STEPS '):
+                self.rotation_circle_steps = int(line[17:])
+            elif line.startswith('LED_BIN '):
+                self.has_binary_leds = line[8] != '0'
+            else:
                 print(f'Skipping: {line}')
-                line = self.read_from_device()
-            print('Header found. Waiting for infos...')
-            line = self.read_from_device()
-            while line != 'Done':
-                if time.time() - start > timeout:
-                    return False
-                if line is None:
-                    time.sleep(0.1)
-                    line = self.read_from_device()
-                    continue
-                if line.startswith('TEST '):
-                    self.testmode = line[5] != '0'
-                elif line.startswith('N_LED '):
-                    self.num_of_leds = int(line[6:])
-                elif line.startswith('DISP_W '):
-                    self.display_width = int(line[7:])
-                elif line.startswith('DISP_H '):
-                    self.display_height = int(line[7:])
-                elif line.startswith('ROT_CIRCLE_STEPS '):
-                    self.rotation_circle_steps = int(line[17:])
-                else:
-                    print(f'Skipping: {line}')
-                line = self.read_from_device()
-            print('End of info received.')
-            print(f'Testmode: {self.testmode}')
-            print(f'Number of LEDs: {self.num_of_leds}')
-            print(f'Display width: {self.display_width}')
-            print(f'Display height: {self.display_height}')
-            print(f'Rotation circle steps: {self.rotation_circle_steps}')
-            return True
+        print('End of info received.')
+        print(f'Testmode: {self.testmode}')
+        print(f'Number of LEDs: {self.num_of_leds}')
+        print(f'Display width: {self.display_width}')
+        print(f'Display height: {self.display_height}')
+        print(f'Rotation circle steps: {self.rotation_circle_steps}')
+        print(f'Binary LED data: {self.has_binary_leds}')
+        return True
 
     def send_image(self, x, y, image):
         '''
@@ -167,13 +451,35 @@ class Device:
         '''
         if self.debug:
             print(f"send_image({x}, {y})")
-        self.image_buffer.append({"x": x, "y": y, "image": image.copy()})
         w, h = image.size
-        data = image.convert("1").rotate(180).tobytes()
-        self.send_to_device(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-        self.send_binary_to_device(data)
+        self.send_packed_image(x, y, w, h, pack_image(image))
         return True
 
+    def send_packed_image(self, x, y, w, h, data):
+        '''
+        Send an image, that has already been converted with pack_image, to be displayed on the screen.
+        '''
+        area = (x, y, w, h)
+        if self.sent_images.get(area) == data:
+            if self.debug:
+                print('Image unchanged, not sending it again.')
+            return True
+        # Sending the image overwrites anything it overlaps on the display
+        for other in [other for other in self.sent_images if areas_overlap(area, other)]:
+            del self.sent_images[other]
+        self.sent_images[area] = data
+        # Keep the packed data, so it can be resent without converting the image again
+        self.image_buffer.append({"x": x, "y": y, "w": w, "h": h, "data": data})
+        self.send_image_data(x, y, w, h, data)
+
+    def send_image_data(self, x, y, w, h, data):
+        '''
+        Send the display command for an area together with the packed image data in a single write.
+        '''
+        if self.debug:
+            print(f'Sending image for {x}/{y} {w}x{h} with {len(data)} bytes.')
+        self.write(_CMD_DISPLAY + b"%d %d %d %d\n" % (x, y, w, h) + data)
+
     def resend_image_data(self):
         '''
         Resend all of the image data from the buffer to buffer in the display.
@@ -181,82 +487,46 @@ class Device:
         if self.debug:
             print('resend_image_data()')
         for part in self.image_buffer:
-            image = part['image']
-            x = part['x']
-            y = part['y']
-            w, h = image.size
-            data = image.convert('1').rotate(180).tobytes()
-            self.send_to_device(CommandCode.DISPLAY.value + " " + str(x) + " " + str(y) + " " + str(w) + " " + str(h))
-            self.send_binary_to_device(data)
+            self.send_image_data(part['x'], part['y'], part['w'], part['h'], part['data'])
         self.image_buffer = []
 
-    def reset_display(self):
+    async def reset_display(self, timeout=5):
         '''
         Reset the display to a blank state.
+        The device answers with "ok", which is awaited so it cannot be taken as the answer to a later request.
         '''
-        self.send_to_device(CommandCode.REFRESH.value + " " + RefreshTypeCode.RESET.value)
+        self.sent_images = {}
+        if await self.request(f"{CommandCode.REFRESH.value} {RefreshTypeCode.RESET.value}", "ok", timeout) is None:
+            if self.debug:
+                print('Timed out...')
+            return False
+        return True
 
-    def update_display(self, full_refresh=True, timeout=5, buffer_data=False):
+    async def update_display(self, full_refresh=True, timeout=5, buffer_data=False):
         '''
         Update the display with the current image buffer.
         '''
-        with self.awaiting_response_lock:
+        if self.debug:
+            print(f'update_display(full_refresh={full_refresh}, timeout={timeout})')
+        # Send the refresh command and wait for "ok" response until the timeout is up.
+        refresh_type = RefreshTypeCode.FULL if full_refresh else RefreshTypeCode.PARTIAL
+        if await self.request(f"{CommandCode.REFRESH.value} {refresh_type.value}", "ok", timeout) is None:
             if self.debug:
-                print(f'update_display(full_refresh={full_refresh}, timeout={timeout})')
-            # Send the refresh command and wait for "ok" response until the timeout is up.
-            start = time.time()
-            self.send_to_device(CommandCode.REFRESH.value + " " + (RefreshTypeCode.FULL.value if full_refresh else RefreshTypeCode.PARTIAL.value))
-            line = self.read_from_device()
-            while line != "ok":
-                if time.time() - start > timeout:
-                    if self.debug:
-                        print('Timed out...')
-                    return False
-                if line == None:
-                    time.sleep(0.1)
-                    line = self.read_from_device()
-                    continue
-                line = self.read_from_device()
-            # Resend all of the image data from the buffer to buffer in the display
-            if buffer_data:
-                self.resend_image_data()
-                self.send_to_device(CommandCode.REFRESH.value + " " + RefreshTypeCode.OFF.value)
-                start = time.time()
-                line = self.read_from_device()
-                while line != "ok":
-                    if time.time() - start > timeout:
-                        if self.debug:
-                            print('Timed out...')
-                        return False
-                    if line == None:
-                        time.sleep(0.1)
-                        line = self.read_from_device()
-                        continue
-                    line = self.read_from_device()
+                print('Timed out...')
+            return False
+        # Resend all of the image data from the buffer to buffer in the display
+        if buffer_data:
+            self.resend_image_data()
+            if await self.request(f"{CommandCode.REFRESH.value} {RefreshTypeCode.OFF.value}", "ok", timeout) is None:
+                if self.debug:
+                    print('Timed out...')
+                return False
 
     def get_area_for(self, function):
         '''
         Get the area of the screen that the image should be displayed in.
         '''
-        banner_space = self.banner_height//2  # Each side gives space for half the banner height
-        tile_height = self.display_height//4               # Tile height is the screen height divided by 4
-        tile_width = (self.display_width//2)-banner_space # Tile width is half the screen minus half the banner height
-
-        if function == "title":
-            # TODO: The controler hangs and fails to upddate the display when the title is less than 40 in height
-            area = (tile_width, 0, 40, self.display_height)
-        elif function == 1:
-            # TODO: Decide what to do with button 1 text, if anything.
-            area = (0, tile_width, self.display_height, self.display_width//2+self.banner_height)
-        elif function <= 5:
-            area = (tile_width+(self.banner_height), (5-function)*tile_height, tile_width+2, tile_height)
-        else:
-            area = (0, (9-function)*tile_height, tile_width+2, tile_height)
-
-        if self.debug:
-            x, y, w, h = area
-            print(f'Area is {x}/{y} {w}x{h}')
-        return area
+        return _area_for(function, self.display_width, self.display_height, self.banner_height, self.debug)
 
     # Resize the image if needed and send it to the controller.
     def send_image_for(self, function, image):
@@ -267,18 +537,30 @@ class Device:
             image = image.resize((w, h))
         self.send_image(x, y, image)
 
-    def send_text_for(self, function, text, subtext="", inverted=False):
+    async def render(self, build_image, *args):
+        '''
+        Run one of the image building functions in the render thread, so the event loop is not blocked.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(self._renderer, build_image, *args)
+
+    async def send_text_for(self, function, text, subtext="", inverted=False):
         if self.debug:
             print(f'send_text_for({function}, {text}, subtext={subtext}, inverted={inverted})')
-        _, _, width, height = self.get_area_for(function)
+        self.send_packed_image(*await self.render(self.build_text_for, function, text, subtext, inverted))
+
+    def build_text_for(self, function, text, subtext="", inverted=False):
+        '''
+        Draw a text label for a function. Returns the area and the packed image data.
+        '''
+        x, y, width, height = self.get_area_for(function)
         image = Image.new("1", (width, height), color=(0 if inverted else 1))
         drawing = ImageDraw.Draw(image)
-        main_text_font = ImageFont.truetype("font/Munro.ttf", 10)
+        main_text_font = _font("font/Munro.ttf", 10)
         left, top, right, bottom = main_text_font.getbbox(text)
         main_text_width = right - left
         main_text_height = bottom - top
 
-        subtext_font = ImageFont.truetype("font/MunroSmall.ttf", 10)
+        subtext_font = _font("font/MunroSmall.ttf", 10)
         left, top, right, bottom  = subtext_font.getbbox(subtext)
         subtext_width = right - left
         if function in (1, 'title'):
@@ -298,57 +580,49 @@ class Device:
         drawing.text(position1, text, font=main_text_font, fill=(1 if inverted else 0))
         if position2 is not None and subtext is not None:
             drawing.multiline_text(position2, subtext, font=subtext_font, align=align, spacing=-2, fill=(1 if inverted else 0))
-        self.send_image_for(function, image)
+        return x, y, width, height, pack_image(image)
 
-    def send_icon_for(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
+    async def send_icon_for(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
         if self.debug:
             print(f'send_icon_for({icon}, inverted={inverted}, centered={centered}, marked={marked}, crossed={crossed})')
-        x, y, w, h = self.get_area_for(function)
-        img = Image.new("1", (w, h), color=(0 if inverted else 1))
-        imgIcon = Image.open(icon).convert("RGB")
-        if inverted:
-            imgIcon = ImageOps.invert(imgIcon)
-        wi, hi = imgIcon.size
-        if function < 6:
-            pos = ((w-wi)//2 if centered else 0, (h - hi)//2)
-        else:
-            pos = ((w-wi)//2 if centered else (w - wi), (h - hi)//2)
-        img.paste(imgIcon, pos)
-
-        if marked:
-            imgMarker = Image.open("icons/chevron-compact-right.png" if function < 6 else "icons/chevron-compact-left.png")
-            wm, hm = imgMarker.size
-            img.paste(imgMarker, (-16,(h - hm)//2) if function < 6 else (w-wm+16,(h - hm)//2), mask=ImageOps.invert(imgMarker.convert("RGB")).convert("1"))
+        self.send_packed_image(*await self.render(self.build_icon_for, function, icon, inverted, centered, marked, crossed))
 
-        if crossed:
-            d = ImageDraw.Draw(img)
-            d.line([pos[0]+5, pos[1]+5, pos[0]+wi-5, pos[1]+hi-5], width=3)
-            d.line([pos[0]+5, pos[1]+hi-5, pos[0]+wi-5, pos[1]+5], width=3)
-
-        self.send_image(x, y, img)
+    def build_icon_for(self, function, icon, inverted=False, centered=True, marked=False, crossed=False):
+        '''
+        Draw an icon for a function. Returns the area and the packed image data.
+        '''
+        x, y, w, h = self.get_area_for(function)
+        return x, y, w, h, _icon_image(icon, w, h, function < 6, inverted, centered, marked, crossed)
 
     def set_leds(self, leds):
         '''
         Set the LEDs to a specific color.
         '''
-        ledStr = [f'{i:06x}' for i in leds]
-        self.led_set_time = time.time()
-        self.led_state = leds
-        self.send_led(ledStr)
+        self.led_set_time = time.monotonic()
+        self.led_state = led_channels(leds)
+        self.led_fade_level = 256
+        self.update_leds(self.led_state)
+        if not self.led_state.any():
+            self.led_state = None   # The LEDs are off, so there is nothing for fade_leds to do
 
     def fade_leds(self):
-        if self.led_state == None:
+        if self.led_state is None:
             return
-        p = (3.5 - (time.time() - self.led_set_time))/0.5 # Stay on for 3 seconds and then fade out over 0.5 seconds
+        p = (3.5 - (time.monotonic() - self.led_set_time))/0.5 # Stay on for 3 seconds and then fade out over 0.5 seconds
         if p >= 1:
             return
         if p <= 0:
             self.led_state = None
-            self.send_led(["000000" for i in range(self.num_of_leds)])
+            self.update_leds(np.zeros((self.num_of_leds, 3), dtype=np.uint8))
+            return
+        # Scale all channels at once with a fixed point factor and skip frames without a visible change.
+        # The factor is quantized to 32 steps, which is still a smooth fade but leaves most frames unchanged.
+        level = int(p*32)*8
+        if level == self.led_fade_level:
             return
-        dimmed_leds = [(int((i & 0xff0000) * p) & 0xff0000) | (int((i & 0xff00) * p) & 0xff00) | (int((i & 0xff) * p) & 0xff) for i in self.led_state]
-        led_str = ['{:06x}'.format(i) for i in dimmed_leds]
-        self.send_led(led_str)
+        self.led_fade_level = level
+        dimmed = (self.led_state.astype(np.uint16) * level >> 8).astype(np.uint8)
+        self.update_leds(dimmed)
 
     def set_status(self, status):
         self.status = status
@@ -1,4 +1,5 @@
 from enum import Enum
+from functools import lru_cache
 from PIL import Image
 
 def event(device, keycode, value=""):
@@ -11,8 +12,36 @@ def event(device, keycode, value=""):
     else:
         return device.value + str(keycode.value)
 
+# The key sequences below are built from keyboard keycodes and cached, so each one is only built once
+
+@lru_cache(maxsize=256)
+def combo(*keys):
+    '''
+    Hold all keys but the last one, type the last one and release the others again.
+    combo(KeyboardKeycode.KEY_LEFT_CTRL, KeyboardKeycode.KEY_C) types Ctrl+C, a single key is just typed.
+    '''
+    *modifiers, key = keys
+    return tuple(event(DeviceCode.KEYBOARD, m, ActionCode.PRESS) for m in modifiers) \
+        + (event(DeviceCode.KEYBOARD, key),) \
+        + tuple(event(DeviceCode.KEYBOARD, m, ActionCode.RELEASE) for m in modifiers)
+
+@lru_cache(maxsize=256)
+def combo_press(*keys):
+    '''
+    Press all keys and keep them pressed until combo_release is sent for them, i.e. when the button is released.
+    '''
+    return tuple(event(DeviceCode.KEYBOARD, key, ActionCode.PRESS) for key in keys)
+
+@lru_cache(maxsize=256)
+def combo_release(*keys):
+    '''
+    Release all keys pressed with combo_press.
+    '''
+    return tuple(event(DeviceCode.KEYBOARD, key, ActionCode.RELEASE) for key in keys)
+
 class CommandCode(Enum):
     ASSIGN = "A"
+    LED_BIN = "B"
     DISPLAY = "D"
     LED = "L"
     REFRESH = "R"
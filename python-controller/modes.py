@@ -2,17 +2,22 @@
 This file contains the different modes that can be selected to be used on the controller.
 Each mode is a class that inherits from ModeBase.
     It can overrides the functions activate, deactivate, poll and animate.
+    activate and poll are coroutines, so they can wait for the display to be updated.
+    Callbacks registered on the device may be coroutine functions as well.
 
 To avoid multiple screen refresh - the modules should not clean-up the display upon deactivation
 Instead, each module is supposed to set at least the area corresponding to each button.
 If a button is not used, it should be set to a blank icon and no key assignment should be made.
 '''
 
+import asyncio
 import time
-from threading import Timer
-from math import ceil, floor
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from colorsys import hsv_to_rgb
 
+import numpy as np
 # pylint: disable=import-error
 import pulsectl                 # Get volume level in Linux, pip3 install pulsectl
 
@@ -20,12 +25,89 @@ from PIL import Image, ImageDraw, ImageFont
 from inkkeys import *
 from mqtt import InkkeysMqtt
 
+# Key event sequences assigned by the modes below. They never change, so they are built only once.
+_NO_EVENT = ()
+_ALT = KeyboardKeycode.KEY_LEFT_ALT
+_CTRL = KeyboardKeycode.KEY_LEFT_CTRL
+_SHIFT = KeyboardKeycode.KEY_LEFT_SHIFT
+# Blender
+_SPACE_PRESS = combo_press(KeyboardKeycode.KEY_SPACE)
+_SPACE_RELEASE = combo_release(KeyboardKeycode.KEY_SPACE)
+_RIGHT = combo(KeyboardKeycode.KEY_RIGHT)
+_LEFT = combo(KeyboardKeycode.KEY_LEFT)
+_KEYPAD_0_PRESS = combo_press(KeyboardKeycode.KEYPAD_0)
+_KEYPAD_0_RELEASE = combo_release(KeyboardKeycode.KEYPAD_0)
+_KEYPAD_DIVIDE_PRESS = combo_press(KeyboardKeycode.KEYPAD_DIVIDE)
+_KEYPAD_DIVIDE_RELEASE = combo_release(KeyboardKeycode.KEYPAD_DIVIDE)
+_KEYPAD_DOT_PRESS = combo_press(KeyboardKeycode.KEYPAD_DOT)
+_KEYPAD_DOT_RELEASE = combo_release(KeyboardKeycode.KEYPAD_DOT)
+_CTRL_F12 = combo(_CTRL, KeyboardKeycode.KEY_F12)
+# Zoom
+_ALT_Q_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_Q)
+_ALT_Q_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_Q)
+_ALT_V_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_V)
+_ALT_V_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_V)
+_ALT_A_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_A)
+_ALT_A_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_A)
+_ALT_S_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_S)
+_ALT_S_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_S)
+_ALT_H_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_H)
+_ALT_H_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_H)
+_ALT_T_PRESS = combo_press(_ALT, KeyboardKeycode.KEY_T)
+_ALT_T_RELEASE = combo_release(_ALT, KeyboardKeycode.KEY_T)
+# Gimp, Alt+B opens the image menu, the following key selects the entry
+_ALT_B_Z = combo(_ALT, KeyboardKeycode.KEY_B) + combo(KeyboardKeycode.KEY_Z)
+_ALT_B_I = combo(_ALT, KeyboardKeycode.KEY_B) + combo(KeyboardKeycode.KEY_I)
+_ALT_B_L = combo(_ALT, KeyboardKeycode.KEY_B) + combo(KeyboardKeycode.KEY_L)
+_ALT_B_S = combo(_ALT, KeyboardKeycode.KEY_B) + combo(KeyboardKeycode.KEY_S)
+_CTRL_SHIFT_V = combo(_CTRL, _SHIFT, KeyboardKeycode.KEY_V)
+_CTRL_SHIFT_N = combo(_CTRL, _SHIFT, KeyboardKeycode.KEY_N)
+_CTRL_SHIFT_J = combo(_CTRL, _SHIFT, KeyboardKeycode.KEY_J)
+_SHIFT_COMMA = combo(_SHIFT, KeyboardKeycode.KEY_COMMA)
+_SHIFT_PERIOD = combo(_SHIFT, KeyboardKeycode.KEY_PERIOD)
+_LEFT_BRACE = combo(KeyboardKeycode.KEY_LEFT_BRACE)
+_RIGHT_BRACE = combo(KeyboardKeycode.KEY_RIGHT_BRACE)
+
+# Colors of the hue circle at full saturation and brightness in 256 steps, used for the rainbow animation
+_RAINBOW = np.array([(int(r*255) << 16) | (int(g*255) << 8) | int(b*255)
+                     for r, g, b in (hsv_to_rgb(h/256, 1, 1) for h in range(256))], dtype=np.uint32)
+
+# Key codes of the buttons by their number
+_PRESS_CODES = {n: KeyCode(f"{n}p") for n in range(1, 10)}
+_RELEASE_CODES = {n: KeyCode(f"{n}r") for n in range(1, 10)}
+
+# Font of the text shown in demo mode, loaded only once
+try:
+    _DEMO_FONT = ImageFont.truetype("arial.ttf", 17)
+except OSError:
+    _DEMO_FONT = ImageFont.load_default()   # Arial is not installed on most Linux systems
+
+@lru_cache(maxsize=4)
+def _demo_text_image(text, display_width, display_height):
+    '''
+    Draw the text shown in demo mode, rotated to run along the middle of the display.
+    Returns the position and the image, which only depend on the arguments and are therefore cached.
+    '''
+    font = _DEMO_FONT
+    _, _, w, h = font.getbbox(text)     # Size measured from the origin the text is drawn at, like the former getsize
+    x = (display_width-h)//2
+    x8 = x & ~7 #needs to be a multiple of 8
+    h8 = (h + x - x8 + 7) & ~7 #needs to be a multiple of 8
+    img = Image.new("1", (w, h8), color=1)
+    d = ImageDraw.Draw(img)
+    d.text((0, x-x8), text, font=font, fill=0)
+    return x8, (display_height-w)//2, img.transpose(Image.ROTATE_90)
+
+
 class ModeBase:
     '''
     A template class
     '''
+    # Modes define their attributes in __slots__, so their instances do not need a __dict__
+    __slots__ = ()
+
     # pylint: disable=unused-argument
-    def activate(self, device: Device):
+    async def activate(self, device: Device):
         '''
         Called when the mode becomes active.
         Usually used to set up static key assignment and icons
@@ -41,7 +123,7 @@ class ModeBase:
         device.clear_callbacks()
 
     # pylint: disable=unused-argument
-    def poll(self, device: Device):
+    async def poll(self, device: Device):
         '''
         Called periodically and typically used to poll a state which you need to monitor.
         The return value is the time in seconds until the next poll, or False if no polling is required.
@@ -56,201 +138,134 @@ class ModeBase:
         device.fade_leds()
 
 
-class ModeBlender (ModeBase):
+class StaticMode (ModeBase):
     '''
-    Simple example. For Blender we just set up a few key assignments with corresponding images.
+    A mode which only shows an icon for each button and assigns fixed key sequences.
+    Simple modes are created with make_static_mode, others can inherit from this class and extend "configure".
     '''
-    def activate(self, device: Device):
-        device.send_text_for("title", "Blender", inverted=True) #Title
-
-        #Button1 (Jog dial press)
-        device.send_text_for(1, "<   Play/Pause   >")
-        device.assign_key(KeyCode.SW1_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_SPACE, ActionCode.PRESS)]) #Play/pause
-        device.assign_key(KeyCode.SW1_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_SPACE, ActionCode.RELEASE)])
-
-        #Jog dial rotation
-        device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_RIGHT)]) #CW = Clock-wise, one frame forward
-        device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT)]) #CCW = Counter clock-wise, one frame back
-
-        #Button2 (top left)
-        device.send_icon_for(2, "icons/camera-reels.png")
-        device.assign_key(KeyCode.SW2_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_0, ActionCode.PRESS)]) #Set view to camera
-        device.assign_key(KeyCode.SW2_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_0, ActionCode.RELEASE)])
-
-        #Button3 (left, second from top)
-        device.send_icon_for(3, "icons/person-bounding-box.png")
-        device.assign_key(KeyCode.SW3_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_DIVIDE, ActionCode.PRESS)]) #Isolation view
-        device.assign_key(KeyCode.SW3_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_DIVIDE, ActionCode.RELEASE)])
-
-        #Button4 (left, third from top)
-        device.send_icon_for(4, "icons/dot.png")
-        device.assign_key(KeyCode.SW4_PRESS, []) #Not used, set to nothing.
-        device.assign_key(KeyCode.SW4_RELEASE, [])
-
-        #Button5 (bottom left)
-        device.send_icon_for(5, "icons/dot.png")
-        device.assign_key(KeyCode.SW5_PRESS, []) #Not used, set to nothing.
-        device.assign_key(KeyCode.SW5_RELEASE, [])
-
-        #Button6 (top right)
-        device.send_icon_for(6, "icons/aspect-ratio.png")
-        device.assign_key(KeyCode.SW6_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_DOT, ActionCode.PRESS)]) #Center on selection
-        device.assign_key(KeyCode.SW6_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEYPAD_DOT, ActionCode.RELEASE)])
-
-        #Button7 (right, second from top)
-        #Button4 (left, third from top)
-        device.send_icon_for(7, "icons/collection.png")
-        device.assign_key(KeyCode.SW7_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_F12), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE)]) #Render sequence
-        device.assign_key(KeyCode.SW7_RELEASE, [])
-
-        #Button8 (right, third from top)
-        device.send_icon_for(8, "icons/dot.png")
-        device.assign_key(KeyCode.SW8_PRESS, []) #Not used, set to nothing.
-        device.assign_key(KeyCode.SW8_RELEASE, [])
-
-        #Button9 (bottom right)
-        device.send_icon_for(9, "icons/dot.png")
-        device.assign_key(KeyCode.SW9_PRESS, []) #Not used, set to nothing.
-        device.assign_key(KeyCode.SW9_RELEASE, [])
-
-        device.update_display()
-
-
-class ModeZoom (ModeBase):
-    jog_function = ""    # Keeps track of the currently selected function of the jog dial
-
-    def activate(self, device: Device):
-        device.send_text_for("title", "Zoom", inverted=True)  # Title
-
-        # Button2 (top left) END MEETING
-        device.send_icon_for(2, "icons/arrow-up-left-circle.png")
-        device.assign_key(KeyCode.SW2_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_Q, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW2_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_Q, ActionCode.RELEASE)])
-
-        # Button3 (left, second from top)
-        device.send_icon_for(3, "icons/camera-video.png")
-        device.assign_key(KeyCode.SW3_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW3_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V, ActionCode.RELEASE)])
-
-        # Button4 (left, third from top)
-        device.send_icon_for(4, "icons/white.png")
-        device.assign_key(KeyCode.SW4_PRESS, [])
-        device.assign_key(KeyCode.SW4_RELEASE, [])
-
-        # Button5 (bottom left)
-        device.send_icon_for(5, "icons/white.png")
-        device.assign_key(KeyCode.SW5_PRESS, [])
-        device.assign_key(KeyCode.SW5_RELEASE, [])
-
-        # Button6 (top right) MUTE
-        device.send_icon_for(6, "icons/mic.png")
-        device.assign_key(KeyCode.SW6_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW6_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_A, ActionCode.RELEASE)])
-
-        # Button7 (right, second from top) SHARE
-        device.send_icon_for(7, "icons/aspect-ratio.png")
-        device.assign_key(KeyCode.SW7_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_S, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW7_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_S, ActionCode.RELEASE)])
-
-        # Button8 (right, third from top) CHAT
-        device.send_icon_for(8, "icons/chat-dots.png")
-        device.assign_key(KeyCode.SW8_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_H, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW8_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_H, ActionCode.RELEASE)])
-
-        # Button9 (bottom right) PAUSE SHARE
-        device.send_icon_for(9, "icons/aspect-ratio-fill.png")
-        device.assign_key(KeyCode.SW9_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW9_RELEASE, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_T, ActionCode.RELEASE)])
-
-        device.update_display()
-
-
-class ModeGimp (ModeBase):
+    __slots__ = ()
+
+    title = ""          # Text of the title area
+    jog_label = None    # Text shown for the jog dial, if any
+    keys = ()           # Further key assignments as (key, events), i.e. for the jog dial
+    buttons = ()        # (button, icon, press events, release events) for buttons 2 to 9
+
+    async def activate(self, device: Device):
+        await device.send_text_for("title", self.title, inverted=True) #Title
+        if self.jog_label is not None:
+            await device.send_text_for(1, self.jog_label)
+        for key, events in self.keys:
+            device.assign_key(key, events)
+        for button, icon, press, release in self.buttons:
+            await device.send_icon_for(button, icon)
+            # Unused buttons are still assigned nothing to clear the previous mode's assignment
+            device.assign_key(_PRESS_CODES[button], press)
+            device.assign_key(_RELEASE_CODES[button], release)
+        await self.configure(device)
+        await device.update_display()
+
+    async def configure(self, device: Device):
+        '''
+        Called by activate before the display is updated to set up anything not covered by the tables.
+        '''
+        pass
+
+
+def make_static_mode(name, title, buttons, jog_label=None, keys=(), doc=None):
+    '''
+    Create a StaticMode class from the tables describing its buttons, see StaticMode for their format.
+    '''
+    return type(name, (StaticMode,), {"__slots__": (), "__doc__": doc, "__module__": __name__,
+                                      "title": title, "jog_label": jog_label, "keys": keys, "buttons": buttons})
+
+
+ModeBlender = make_static_mode("ModeBlender", "Blender",
+    doc="Simple example. For Blender we just set up a few key assignments with corresponding images.",
+    jog_label="<   Play/Pause   >",
+    keys=(
+        (KeyCode.SW1_PRESS, _SPACE_PRESS),    # Jog dial press: Play/pause
+        (KeyCode.SW1_RELEASE, _SPACE_RELEASE),
+        (KeyCode.JOG_CW, _RIGHT),             # CW = Clock-wise, one frame forward
+        (KeyCode.JOG_CCW, _LEFT),             # CCW = Counter clock-wise, one frame back
+    ),
+    buttons=(
+        (2, "icons/camera-reels.png", _KEYPAD_0_PRESS, _KEYPAD_0_RELEASE),             # top left: Set view to camera
+        (3, "icons/person-bounding-box.png", _KEYPAD_DIVIDE_PRESS, _KEYPAD_DIVIDE_RELEASE), # left, second from top: Isolation view
+        (4, "icons/dot.png", _NO_EVENT, _NO_EVENT),                                   # left, third from top: Not used
+        (5, "icons/dot.png", _NO_EVENT, _NO_EVENT),                                   # bottom left: Not used
+        (6, "icons/aspect-ratio.png", _KEYPAD_DOT_PRESS, _KEYPAD_DOT_RELEASE),         # top right: Center on selection
+        (7, "icons/collection.png", _CTRL_F12, _NO_EVENT),                            # right, second from top: Render sequence
+        (8, "icons/dot.png", _NO_EVENT, _NO_EVENT),                                   # right, third from top: Not used
+        (9, "icons/dot.png", _NO_EVENT, _NO_EVENT),                                   # bottom right: Not used
+    ))
+
+ModeZoom = make_static_mode("ModeZoom", "Zoom",
+    doc="Controls for Zoom meetings, using its default keyboard shortcuts.",
+    buttons=(
+        (2, "icons/arrow-up-left-circle.png", _ALT_Q_PRESS, _ALT_Q_RELEASE),  # top left: END MEETING
+        (3, "icons/camera-video.png", _ALT_V_PRESS, _ALT_V_RELEASE),         # left, second from top: VIDEO
+        (4, "icons/white.png", _NO_EVENT, _NO_EVENT),                        # left, third from top
+        (5, "icons/white.png", _NO_EVENT, _NO_EVENT),                        # bottom left
+        (6, "icons/mic.png", _ALT_A_PRESS, _ALT_A_RELEASE),                  # top right: MUTE
+        (7, "icons/aspect-ratio.png", _ALT_S_PRESS, _ALT_S_RELEASE),         # right, second from top: SHARE
+        (8, "icons/chat-dots.png", _ALT_H_PRESS, _ALT_H_RELEASE),            # right, third from top: CHAT
+        (9, "icons/aspect-ratio-fill.png", _ALT_T_PRESS, _ALT_T_RELEASE),    # bottom right: PAUSE SHARE
+    ))
+
+
+class ModeGimp (StaticMode):
     '''
     The Gimp example is similar to Blender, but we add a callback to pressing the jog dial to switch functions
     '''
 
-    # Keeps track of the currently selected function of the jog dial
-    jog_function = ""
-
-    def activate(self, device: Device):
-        device.send_text_for("title", "Gimp", inverted=True)  #Title
-
-        # Button2 (top left)
-        device.send_icon_for(2, "icons/fullscreen.png")
-        # Cut to selection (this shortcut appears to be language dependent, so you will probably need to change it)
-        device.assign_key(KeyCode.SW2_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_B), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_Z)])
-        device.assign_key(KeyCode.SW2_RELEASE, [])
-
-        # Button3 (left, second from top)
-        device.send_icon_for(3, "icons/upc-scan.png")
-        # Cut to content (this shortcut appears to be language dependent, so you will probably need to change it)
-        device.assign_key(KeyCode.SW3_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_B), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_I)])
-        device.assign_key(KeyCode.SW3_RELEASE, [])
-
-        # Button4 (left, third from top)
-        device.send_icon_for(4, "icons/crop.png")
-        # Canvas size (this shortcut appears to be language dependent, so you will probably need to change it)
-        device.assign_key(KeyCode.SW4_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_B), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_L)])
-        device.assign_key(KeyCode.SW4_RELEASE, [])
-
-        # Button5 (bottom left)
-        device.send_icon_for(5, "icons/arrows-angle-expand.png")
-        # Resize (this shortcut appears to be language dependent, so you will probably need to change it)
-        device.assign_key(KeyCode.SW5_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_B), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_ALT, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_S)])
-        device.assign_key(KeyCode.SW5_RELEASE, [])
-
-        # Button6 (top right)
-        device.send_icon_for(6, "icons/clipboard-plus.png")
-        # Paste as new image
-        device.assign_key(KeyCode.SW6_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_V), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
-        device.assign_key(KeyCode.SW6_RELEASE, [])
-
-        # Button7 (right, second from top)
-        device.send_icon_for(7, "icons/layers-half.png")
-        # New layer
-        device.assign_key(KeyCode.SW7_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_N), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
-        device.assign_key(KeyCode.SW7_RELEASE, [])
-
-        # Button8 (right, third from top)
-        device.send_icon_for(8, "icons/arrows-fullscreen.png")
-        # Zoom to fill screen
-        device.assign_key(KeyCode.SW8_PRESS, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_J), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_CTRL, ActionCode.RELEASE), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
-        device.assign_key(KeyCode.SW8_RELEASE, [])
-
-        # Button9 (bottom right)
-        device.send_icon_for(9, "icons/dot.png")
-        device.assign_key(KeyCode.SW9_PRESS, []) # Not used, set to nothing.
-        device.assign_key(KeyCode.SW9_RELEASE, [])
-
-
+    __slots__ = ("jog_function", "_device")
+
+    title = "Gimp"
+    # The "Alt+B" shortcuts appear to be language dependent, so you will probably need to change them
+    buttons = (
+        (2, "icons/fullscreen.png", _ALT_B_Z, _NO_EVENT),             # top left: Cut to selection
+        (3, "icons/upc-scan.png", _ALT_B_I, _NO_EVENT),               # left, second from top: Cut to content
+        (4, "icons/crop.png", _ALT_B_L, _NO_EVENT),                   # left, third from top: Canvas size
+        (5, "icons/arrows-angle-expand.png", _ALT_B_S, _NO_EVENT),    # bottom left: Resize
+        (6, "icons/clipboard-plus.png", _CTRL_SHIFT_V, _NO_EVENT),    # top right: Paste as new image
+        (7, "icons/layers-half.png", _CTRL_SHIFT_N, _NO_EVENT),       # right, second from top: New layer
+        (8, "icons/arrows-fullscreen.png", _CTRL_SHIFT_J, _NO_EVENT), # right, third from top: Zoom to fill screen
+        (9, "icons/dot.png", _NO_EVENT, _NO_EVENT),                   # bottom right: Not used
+    )
+
+    def __init__(self):
+        self.jog_function = ""  # Keeps track of the currently selected function of the jog dial
+        self._device = None     # Device the mode is active on, used by the callbacks
+
+    async def configure(self, device: Device):
+        self._device = device
         self.jog_function = ""
 
-        # This toggles the jog function and sets up key assignments and the label for the jog dial. It calls "updateDiplay()" if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
-        def toggle_jog_function(update=True):
-            if self.jog_function == "size":  # Tool opacity in GIMP
-                device.clear_callback(KeyCode.JOG)
-                device.send_text_for(1, "Tool opacity")
-                device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_COMMA), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
-                device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.PRESS), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_PERIOD), event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_SHIFT, ActionCode.RELEASE)])
-                self.jog_function = "opacity"
-            else:                            # Tool size in GIMP
-                device.clear_callback(KeyCode.JOG)
-                device.send_text_for(1, "Tool size")
-                device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT_BRACE)])
-                device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_RIGHT_BRACE)])
-                self.jog_function = "size"
-
-            if update:
-                device.update_display()
-
-
         # Button 1 / jog dial press
-        device.register_callback(toggle_jog_function, KeyCode.JOG_PRESS) # set up the callback for the jog dial press
-        device.assign_key(KeyCode.SW1_PRESS, [])                         # clear the key assignment for the button
-        device.assign_key(KeyCode.SW1_RELEASE, [])
-        toggle_jog_function(False)      # call toggle_jog_function to set the initilal label and assignment
-        device.update_display()          # refresh the display
+        device.register_callback(self._toggle_jog, KeyCode.JOG_PRESS) # set up the callback for the jog dial press
+        device.assign_key(KeyCode.SW1_PRESS, _NO_EVENT)                         # clear the key assignment for the button
+        device.assign_key(KeyCode.SW1_RELEASE, _NO_EVENT)
+        await self._toggle_jog(False)      # call _toggle_jog to set the initilal label and assignment
+
+    # This toggles the jog function and sets up key assignments and the label for the jog dial. It calls "updateDiplay()" if update is not explicitly set to False (for example if you need to update more parts of the display before updating it.)
+    async def _toggle_jog(self, update=True):
+        device = self._device
+        # The function is switched before anything is awaited, so a second press while drawing toggles it again
+        if self.jog_function == "size":  # Tool opacity in GIMP
+            device.clear_callback(KeyCode.JOG)
+            device.assign_key(KeyCode.JOG_CW, _SHIFT_COMMA)
+            device.assign_key(KeyCode.JOG_CCW, _SHIFT_PERIOD)
+            self.jog_function = "opacity"
+            await device.send_text_for(1, "Tool opacity")
+        else:                            # Tool size in GIMP
+            device.clear_callback(KeyCode.JOG)
+            device.assign_key(KeyCode.JOG_CW, _LEFT_BRACE)
+            device.assign_key(KeyCode.JOG_CCW, _RIGHT_BRACE)
+            self.jog_function = "size"
+            await device.send_text_for(1, "Tool size")
+
+        if update:
+            await device.update_display()
 
 
 class ModeFallback (ModeBase):
@@ -259,157 +274,187 @@ class ModeFallback (ModeBase):
     It also uses a switchable Jog dial but most of its functions give a feedback via LED.
     Also, we use MQTT (via a separately defined class) to get data from a CO2 sensor and control a light (both including feedback)
     '''
+    __slots__ = ("mqtt", "jog_function", "light_state", "is_demo_active", "_pulse", "_volume_thresholds", "_leds_blue", "_device")
 
     def __init__(self, mqtt: InkkeysMqtt = None):
         self.mqtt = mqtt
         self.jog_function = ""      # current function of the jog dial
         self.light_state = None      # current state of the light in my office
         self.is_demo_active = False     # demo mode active or not
+        self._pulse = None      # connection to PulseAudio, kept open while the mode is active
+        self._volume_thresholds = ()    # volume above which each LED is lit
+        self._leds_blue = []    # all LEDs blue, shown as a CO2 warning
+        self._device = None     # device the mode is active on, used by the callbacks
 
-    def activate(self, device: Device):
-        device.send_text_for("title", "Default", inverted=True) # Title
-
+    # Buttons with a fixed function as (button, icon, press events, release events)
+    _BUTTONS = (
         ### Buttons 2, 3, 6 and 7 are media controls ###
-        device.send_icon_for(2, "icons/play.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW2_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PLAY_PAUSE, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW2_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PLAY_PAUSE, ActionCode.RELEASE)])
-        device.send_icon_for(3, "icons/skip-start.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW3_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PREV, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW3_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PREV, ActionCode.RELEASE)])
-
-        device.send_icon_for(6, "icons/stop.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW6_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_STOP, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW6_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_STOP, ActionCode.RELEASE)])
-        device.send_icon_for(7, "icons/skip-end.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW7_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_NEXT, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW7_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_NEXT, ActionCode.RELEASE)])
-
+        (2, "icons/play.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PLAY_PAUSE, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PLAY_PAUSE, ActionCode.RELEASE),)),
+        (3, "icons/skip-start.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PREV, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_PREV, ActionCode.RELEASE),)),
+        (6, "icons/stop.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_STOP, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_STOP, ActionCode.RELEASE),)),
+        (7, "icons/skip-end.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_NEXT, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_NEXT, ActionCode.RELEASE),)),
         ### Buttons 5 and 9 are shortcuts to applications ###
-        device.send_icon_for(5, "icons/envelope.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW5_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_EMAIL_READER, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW5_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_EMAIL_READER, ActionCode.RELEASE)])
-        device.send_icon_for(9, "icons/calculator.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW9_PRESS, [event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_CALCULATOR, ActionCode.PRESS)])
-        device.assign_key(KeyCode.SW9_RELEASE, [event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_CALCULATOR, ActionCode.RELEASE)])
+        (5, "icons/envelope.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_EMAIL_READER, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_EMAIL_READER, ActionCode.RELEASE),)),
+        (9, "icons/calculator.png", (event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_CALCULATOR, ActionCode.PRESS),), (event(DeviceCode.CONSUMER, ConsumerKeycode.CONSUMER_CALCULATOR, ActionCode.RELEASE),)),
+        ### Buttons 4 and 8 are handled by callbacks, see activate ###
+    )
+
+    # Label of each function of the jog dial
+    _JOG_LABELS = {"wheel": "Mouse Wheel", "arrow": "Arrow Keys", "volume": "Volume"}
+
+    async def activate(self, device: Device):
+        self._device = device
+        self._leds_blue = [0x0000ff] * device.num_of_leds
+        self.light_state = self.mqtt.get_lights()
+        self.jog_function = ""
 
-        ### Button 4 controls the light in my office and displays its state ###
-        def toggle_light():
-            target = not self.light_state
-            self.mqtt.set_lights(target)
-            self.light_state = target
-            self.show_light_state(device)
+        await self._configure_buttons(device)
+
+        for button, _, press, release in self._BUTTONS:
+            device.assign_key(_PRESS_CODES[button], press)
+            device.assign_key(_RELEASE_CODES[button], release)
 
-        self.light_state = self.mqtt.get_lights
-        self.show_light_state(device, False)
+        ### Button 4 controls the light in my office and displays its state ###
+        device.assign_key(KeyCode.SW4_PRESS, _NO_EVENT)
+        device.assign_key(KeyCode.SW4_RELEASE, _NO_EVENT)
+        device.register_callback(self._toggle_light, KeyCode.SW4_PRESS)
 
-        device.assign_key(KeyCode.SW4_PRESS, [])
-        device.assign_key(KeyCode.SW4_RELEASE, [])
-        device.register_callback(toggle_light, KeyCode.SW4_PRESS)
+        ### MQTT messages are only handled when the light or the CO2 level actually changes ###
+        self.mqtt.on_lights_change(self._on_lights_change)
+        self.mqtt.on_co2_change(self._on_co2_change)
+        # A level that is already too high is not reported as a change, so it is checked once now
+        self._show_co2(self.mqtt.get_co2())
 
         ### Button 8 set display and LEDs to a demo state (only used for videos and pictures of the thing)
-        def toggle_demo():
-            if self.is_demo_active:
-                self.is_demo_active = False
-                img = Image.new("1", (device.display_width, device.display_height), color=1)
-                device.send_image(0, 0, img)
-                self.activate(device) #Recreate the screen content after the demo
-            else:
-                self.is_demo_active = True
-                self.activate(device) #Recreate the screen because with demo active, the buttons will align differently to give room for "there.oughta.be"
-                text = "there.oughta.be/a/macro-keyboard"
-                font = ImageFont.truetype("arial.ttf", 17)
-                w, h = font.getsize(text)
-                x = (device.display_width-h)//2
-                x8 = floor(x / 8) * 8 #needs to be a multiple of 8
-                h8 = ceil((h + x - x8) / 8) * 8 #needs to be a multiple of 8
-                img = Image.new("1", (w, h8), color=1)
-                d = ImageDraw.Draw(img)
-                d.text((0, x-x8), text, font=font, fill=0)
-                device.send_image(x8, (device.display_height-w)//2, img.transpose(Image.ROTATE_90))
-                device.update_display(True)
-
-        device.register_callback(toggle_demo, KeyCode.SW8_PRESS)
-        device.send_icon_for(8, "icons/emoji-sunglasses.png", centered=not self.is_demo_active)
-        device.assign_key(KeyCode.SW8_PRESS, [])
-        device.assign_key(KeyCode.SW8_RELEASE, [])
+        device.register_callback(self._toggle_demo, KeyCode.SW8_PRESS)
+        device.assign_key(KeyCode.SW8_PRESS, _NO_EVENT)
+        device.assign_key(KeyCode.SW8_RELEASE, _NO_EVENT)
 
         ### The jog wheel can be pressed to switch between three functions: Volume control, mouse wheel, arrow keys left/right ###
-        def show_volume(n):
-            with pulsectl.Pulse('inkkeys') as pulse:
-                sinkList = pulse.sink_list()
-                name = pulse.server_info().default_sink_name
-                for sink in sinkList:
-                    if sink.name == name:
-                        vol = sink.volume.value_flat
-                off = 0x00ff00
-                on = 0xff0000
-                leds = [on if vol > i/(device.num_of_leds-1) else off for i in range(device.num_of_leds)]
-                device.set_leds(leds)
-
-        self.jog_function = ""
+        # A single LED lights up at any volume above zero
+        self._volume_thresholds = tuple(i/max(device.num_of_leds-1, 1) for i in range(device.num_of_leds))
 
-        def toggle_jog_function(update=True):
-            if self.jog_function == "wheel":
-                device.clear_callback(KeyCode.JOG)
-                device.send_text_for(1, "Arrow Keys")
-                device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_RIGHT)])
-                device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.KEYBOARD, KeyboardKeycode.KEY_LEFT)])
-                self.jog_function = "arrow"
-            elif self.jog_function == "arrow":
-                device.send_text_for(1, "Volume")
-                device.register_callback(show_volume, KeyCode.JOG)
-                device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_VOL_UP)])
-                device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_VOL_DOWN)])
-                self.jog_function = "volume"
-            else:
-                device.clear_callback(KeyCode.JOG)
-                device.send_text_for(1, "Mouse Wheel")
-                device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.MOUSE, MouseAxisCode.MOUSE_WHEEL, 1)])
-                device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.MOUSE, MouseAxisCode.MOUSE_WHEEL, -1)])
-                self.jog_function = "wheel"
-
-            if update:
-                device.update_display()
-
-        device.register_callback(toggle_jog_function, KeyCode.JOG_PRESS)
-        device.assign_key(KeyCode.SW1_PRESS, [])
-        device.assign_key(KeyCode.SW1_RELEASE, [])
-        toggle_jog_function(False)
+        device.register_callback(self._toggle_jog, KeyCode.JOG_PRESS)
+        device.assign_key(KeyCode.SW1_PRESS, _NO_EVENT)
+        device.assign_key(KeyCode.SW1_RELEASE, _NO_EVENT)
+        await self._toggle_jog(False)
 
         ### All set, let's update the display ###
-        device.update_display()
+        await device.update_display()
+
+    async def _configure_buttons(self, device: Device):
+        '''
+        Draw the title, the icons and the label of the jog dial without updating the display.
+        This is all that changes when the demo is toggled, the icons move aside to give room for "there.oughta.be".
+        '''
+        await device.send_text_for("title", "Default", inverted=True) # Title
+        for button, icon, _, _ in self._BUTTONS:
+            await device.send_icon_for(button, icon, centered=not self.is_demo_active)
+        await self.show_light_state(device, False)
+        await device.send_icon_for(8, "icons/emoji-sunglasses.png", centered=not self.is_demo_active)
+        if self.jog_function in self._JOG_LABELS:
+            await device.send_text_for(1, self._JOG_LABELS[self.jog_function])
+
+    async def _toggle_light(self):
+        target = not self.light_state
+        self.mqtt.set_lights(target)
+        self.light_state = target
+        await self.show_light_state(self._device)
+
+    async def _on_lights_change(self, state):
+        if state != self.light_state:
+            # The state is kept during the demo as well, so the icon is right once the demo ends
+            self.light_state = state
+            if not self.is_demo_active:
+                await self.show_light_state(self._device)
+
+    async def _on_co2_change(self, co2):
+        self._show_co2(co2)
+
+    def _show_co2(self, co2):
+        '''
+        Turn all LEDs blue as a warning if the CO2 level is too high.
+        '''
+        if not self.is_demo_active and co2 is not None and co2 > 1000:
+            self._device.set_leds(self._leds_blue)
 
-    def poll(self, device: Device):
+    async def _toggle_demo(self):
+        device = self._device
+        self.is_demo_active = not self.is_demo_active
         if not self.is_demo_active:
-            co2 = self.mqtt.get_co2()
-            if co2 is not None and co2 > 1000:
-                leds = [0x0000ff for i in range(device.num_of_leds)]
-                device.set_leds(leds)
-            light = self.mqtt.get_lights()
-            if light != self.light_state:
-                self.light_state = light
-                self.show_light_state(device)
-        # Return the time in seconds until the next poll
-        # This is not a real poll but a reaction to the MQTT messages
-        return 10
+            await device.reset_display()     # Clear the demo text, the display does this without receiving a blank image
+        # Only the screen content changes, key assignments and callbacks stay as they are
+        await self._configure_buttons(device)
+        if self.is_demo_active:
+            device.send_image(*_demo_text_image("there.oughta.be/a/macro-keyboard", device.display_width, device.display_height))
+        await device.update_display(True)
+
+    def _show_volume(self, n):
+        try:
+            if self._pulse is None:
+                self._pulse = pulsectl.Pulse('inkkeys')
+            # The default sink can be changed at any time, so it is looked up again
+            name = self._pulse.server_info().default_sink_name
+            vol = self._pulse.get_sink_by_name(name).volume.value_flat
+        except pulsectl.PulseError:
+            # The connection is lost if PulseAudio is restarted, a new one is opened the next time
+            self.close_pulse()
+            return
+        # The thresholds are sorted, so the number of LEDs to light up is found by bisection
+        lit = bisect_left(self._volume_thresholds, vol)
+        self._device.set_leds([0xff0000]*lit + [0x00ff00]*(self._device.num_of_leds - lit))
+
+    async def _toggle_jog(self, update=True):
+        device = self._device
+        # The function is switched before anything is awaited, so a second press while drawing toggles it again
+        if self.jog_function == "wheel":
+            device.clear_callback(KeyCode.JOG)
+            device.assign_key(KeyCode.JOG_CW, _RIGHT)
+            device.assign_key(KeyCode.JOG_CCW, _LEFT)
+            self.jog_function = "arrow"
+        elif self.jog_function == "arrow":
+            device.register_callback(self._show_volume, KeyCode.JOG)
+            device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_VOL_UP)])
+            device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.CONSUMER, ConsumerKeycode.MEDIA_VOL_DOWN)])
+            self.jog_function = "volume"
+        else:
+            device.clear_callback(KeyCode.JOG)
+            device.assign_key(KeyCode.JOG_CW, [event(DeviceCode.MOUSE, MouseAxisCode.MOUSE_WHEEL, 1)])
+            device.assign_key(KeyCode.JOG_CCW, [event(DeviceCode.MOUSE, MouseAxisCode.MOUSE_WHEEL, -1)])
+            self.jog_function = "wheel"
+        await device.send_text_for(1, self._JOG_LABELS[self.jog_function])
+
+        if update:
+            await device.update_display()
+
+    def deactivate(self, device: Device):
+        self.mqtt.on_lights_change(None)
+        self.mqtt.on_co2_change(None)
+        self.close_pulse()
+        super().deactivate(device)
+
+    def close_pulse(self):
+        '''
+        Close the connection to PulseAudio, if there is one.
+        '''
+        if self._pulse is not None:
+            self._pulse.close()
+            self._pulse = None
 
     # Called to update the icon of button 4, showing the state of the office light
-    def show_light_state(self, device: Device, update=True):
+    async def show_light_state(self, device: Device, update=True):
         if self.light_state:
-            device.send_icon_for(4, "icons/lightbulb.png", centered=not self.is_demo_active)
+            await device.send_icon_for(4, "icons/lightbulb.png", centered=not self.is_demo_active)
         else:
-            device.send_icon_for(4, "icons/lightbulb-off.png", centered=not self.is_demo_active)
+            await device.send_icon_for(4, "icons/lightbulb-off.png", centered=not self.is_demo_active)
         if update:
-            device.update_display()
+            await device.update_display()
 
     def animate(self, device: Device):
         if self.is_demo_active: # Set LEDs animation in demo mode
-            def rgbTupleToInt(rgb):
-                return (int(rgb[0]*255) << 16) | (int(rgb[1]*255) << 8) | int(rgb[2]*255)
-
-            t = time.time()
-            leds = [rgbTupleToInt(hsv_to_rgb(t + i/device.num_of_leds, 1, 1)) for i in range(device.num_of_leds)]
-            device.set_leds(leds)
+            # The hue turns once per second and is spread over the ring of LEDs
+            t = int(time.time()*256)
+            device.set_leds(_RAINBOW[(t + np.arange(device.num_of_leds)*256//device.num_of_leds) & 255])
         else:               # Otherwise call "fade_leds" to create a fade animation for any color set anywhere in this mode
             device.fade_leds()
 
@@ -421,8 +466,10 @@ class ModeOBS (ModeBase):
     So, you need to adapt these to your setup.
     We subscribe to OBS events and show the status on the key and LEDs.
     '''
-    ws = None           # Websocket instance
-    currentScene = None # Keep track of current scene
+    __slots__ = ("ws", "currentScene", "_leds_red", "_leds_green", "buttonIcons", "sceneByName", "statesByItem", "updateHandle", "updateTask", "orderHandle", "orderShow", "orderHide", "obsCalls")
+
+    updateDelay = 0.05  # Time in seconds to wait for further OBS events before refreshing the display
+    orderDuration = 3   # Time in seconds the "Order" source is shown
 
     # Scenes assigned to buttons with respective icons.
     scenes = [\
@@ -439,15 +486,44 @@ class ModeOBS (ModeBase):
                 {"items": [("Moderation", "Mic: Moderation"), ("Closeup", "Mic: Closeup"), ("Slides", "Mic: Closeup")], "icon": "icons/mic.png", "button": 9, "current": True}, \
              ]
 
+    def __init__(self):
+        self.ws = None              # Websocket instance
+        self.currentScene = None    # Keep track of current scene
+        self._leds_red = []         # All LEDs red or green, set up in activate for the number of LEDs of the device
+        self._leds_green = []
+        self.buttonIcons = {}       # Icon currently shown for each button as (icon, marked, crossed)
+        # Index of the scenes by their name and of the states by their (scene, item) combinations
+        self.sceneByName = {scene["name"]: scene for scene in self.scenes}
+        self.statesByItem = {}
+        for state in self.states:
+            for item in state["items"]:
+                self.statesByItem.setdefault(item, []).append(state)
+        self.updateHandle = None    # Pending display refresh scheduled on the event loop
+        self.updateTask = None      # Display refresh currently running
+        self.orderHandle = None     # Pending end of the "Order" source scheduled on the event loop
+        self.orderShow = None       # Requests to show and hide the "Order" source, built in activate
+        self.orderHide = None
+        # Requests to OBS are made by a single separate thread, so a slow reply does not hold up the keys and they stay in order
+        self.obsCalls = ThreadPoolExecutor(max_workers=1)
+
+    # Sends a request to OBS without waiting for the reply. Failures are only reported.
+    def callInBackground(self, request):
+        self.obsCalls.submit(self.ws.call, request).add_done_callback(self.reportFailedCall)
+
+    @staticmethod
+    def reportFailedCall(future):
+        if not future.cancelled() and future.exception() is not None:
+            print("OBS request failed: ", future.exception())
+
     # Switch to scene with name "name"
     def setScene(self, name):
-        self.ws.call(requests.SetCurrentScene(name))
+        self.callInBackground(requests.SetCurrentScene(name))
 
     # Toggle source visibility as defined in a state (see states above)
     def toggleState(self, state):
         visible = not state["current"]
         for item in state["items"]:
-            self.ws.call(requests.SetSceneItemProperties(item[1], scene_name=item[0], visible=visible))
+            self.callInBackground(requests.SetSceneItemProperties(item[1], scene_name=item[0], visible=visible))
 
     # Generates a callback function which in turn calls "setScene" with the fixed scene "name" without requiring a parameter
     def getSetSceneCallback(self, name):
@@ -457,57 +533,115 @@ class ModeOBS (ModeBase):
     def getToggleStateCallback(self, state):
         return lambda: self.toggleState(state)
 
+    # Sends the icon for a button unless it is already shown. Returns True if the icon has been sent.
+    async def sendIconIfChanged(self, device, button, icon, marked=False, crossed=False):
+        if self.buttonIcons.get(button) == (icon, marked, crossed):
+            return False
+        self.buttonIcons[button] = (icon, marked, crossed)
+        await device.send_icon_for(button, icon, centered=True, marked=marked, crossed=crossed)
+        return True
+
     # Updates the buttons associated with scenes. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should call updateDisplay()
-    def updateSceneButtons(self, device, newScene, init=False):
+    async def updateSceneButtons(self, device, newScene, init=False):
         if self.currentScene == newScene:
             return False
-        for scene in self.scenes:
-            if (init and newScene != scene["name"]) or self.currentScene == scene["name"]:
-                device.sendIconFor(scene["button"], scene["icon"], centered=True)
-            elif newScene == scene["name"]:
-                device.sendIconFor(scene["button"], scene["icon"], centered=True, marked=True)
+        anyUpdate = False
+        # Only the buttons of the previous and the new scene change, unless all of them need to be initialized
+        changed = self.scenes if init else (self.sceneByName.get(self.currentScene), self.sceneByName.get(newScene))
+        for scene in changed:
+            if scene is not None:
+                anyUpdate |= await self.sendIconIfChanged(device, scene["button"], scene["icon"], marked=newScene == scene["name"])
         self.currentScene = newScene
-        return True
+        return anyUpdate
 
     # Updates the buttons associated with states. Unless "init" is set to true, it only updates changed parts of the display and returns True if anything has changed so that the calling function should call updateDisplay()
-    def updateStateButtons(self, device, scene, item, visible, init=False):
+    async def updateStateButtons(self, device, scene, item, visible, init=False):
         anyUpdate = False
-        for state in self.states:
-            if init or ((scene, item) in state["items"] and visible != state["current"]):
-                device.sendIconFor(state["button"], state["icon"], centered=True, crossed=not (state["current"] if init else visible))
-                anyUpdate = True
-                if not init:
-                    state["current"] = visible
+        if init:
+            for state in self.states:
+                anyUpdate |= await self.sendIconIfChanged(device, state["button"], state["icon"], crossed=not state["current"])
+            return anyUpdate
+        for state in self.statesByItem.get((scene, item), ()):
+            if visible != state["current"]:
+                anyUpdate |= await self.sendIconIfChanged(device, state["button"], state["icon"], crossed=not visible)
+                state["current"] = visible
         return anyUpdate
 
+    # Shows the "Order" source for "orderDuration" seconds. Another press while it is shown restarts its time instead of queuing a second stop.
+    def playOrder(self):
+        self.callInBackground(self.orderShow)
+        if self.orderHandle is not None:
+            self.orderHandle.cancel()
+        self.orderHandle = asyncio.get_running_loop().call_later(self.orderDuration, self.stopOrder)
+
+    def stopOrder(self):
+        self.orderHandle = None
+        self.callInBackground(self.orderHide)
+
+    # Schedules a display refresh. OBS often sends a burst of events, which are collected until no new one arrives for "updateDelay" seconds and then result in a single refresh.
+    def scheduleDisplayUpdate(self, device):
+        if self.updateHandle is not None:
+            self.updateHandle.cancel()
+        self.updateHandle = asyncio.get_running_loop().call_later(self.updateDelay, self.startDisplayUpdate, device)
+
+    def startDisplayUpdate(self, device):
+        self.updateHandle = None
+        self.updateTask = asyncio.ensure_future(device.update_display())
+        self.updateTask.add_done_callback(self.finishDisplayUpdate)
+
+    def finishDisplayUpdate(self, task):
+        if self.updateTask is task:
+            self.updateTask = None
+
+    def cancelDisplayUpdate(self):
+        if self.updateHandle is not None:
+            self.updateHandle.cancel()
+            self.updateHandle = None
+
     def updateLED(self, device):
         '''
         Changes the LED color depending on the current scene and the state of the microphones
         '''
-        if self.currentScene == "Video-Mute" or self.states[2]["current"] == False:
-            leds = [0xff0000 for i in range(device.nLeds)] # Either this is the empty "Video-Mute" scene or the mics are muted -> red
-        else:
-            leds = [0x00ff00 for i in range(device.nLeds)] # In any other case the mics are live -> green
-        device.setLeds(leds)
+        # Either this is the empty "Video-Mute" scene or the mics are muted -> red, in any other case the mics are live -> green
+        muted = self.currentScene == "Video-Mute" or not self.states[2]["current"]
+        device.set_leds(self._leds_red if muted else self._leds_green)
 
-    def activate(self, device):
-        self.ws = obsws("localhost", 4444) # Connect to websockets plugin in OBS
+    async def activate(self, device):
+        self._leds_red = [0xff0000] * device.num_of_leds
+        self._leds_green = [0x00ff00] * device.num_of_leds
+        self.buttonIcons = {}   # The display has been reset when switching to this mode
+
+        ws = self.ws = obsws("localhost", 4444) # Connect to websockets plugin in OBS
 
         # Callback if OBS is shutting down
         def on_exit(message):
-            self.ws.disconnect()
+            ws.disconnect()
+
+        # OBS calls back from its own thread, so the updates are handed over to the event loop
+        loop = asyncio.get_running_loop()
+
+        # Events still arriving after the mode has been deactivated must not touch the display of the next mode
+        async def scene_changed(name):
+            if self.ws is not ws:
+                return
+            if await self.updateSceneButtons(device, name):
+                self.scheduleDisplayUpdate(device) #Only update if parts of the display actually changed
+            self.updateLED(device)
+
+        async def visibility_changed(scene, item, visible):
+            if self.ws is not ws:
+                return
+            if await self.updateStateButtons(device, scene, item, visible):
+                self.scheduleDisplayUpdate(device) #Only update if parts of the display actually changed
+            self.updateLED(device)
 
         # Callback if the scene changes
         def on_scene(message):
-            if self.updateSceneButtons(device, message.getSceneName()):
-                device.update_display() #Only update if parts of the display actually changed
-            self.updateLED(device)
+            asyncio.run_coroutine_threadsafe(scene_changed(message.getSceneName()), loop).add_done_callback(report_exception)
 
         # Callback if the visibility of a source changes
         def on_visibility_changed(message):
-            if self.updateStateButtons(device, message.getSceneName(), message.getItemName(), message.getItemVisible()):
-                device.update_display() #Only update if parts of the display actually changed
-            self.updateLED(device)
+            asyncio.run_coroutine_threadsafe(visibility_changed(message.getSceneName(), message.getItemName(), message.getItemVisible()), loop).add_done_callback(report_exception)
 
         # Register callbacks to OBS
         self.ws.register(on_exit, events.Exiting)
@@ -515,51 +649,61 @@ class ModeOBS (ModeBase):
         self.ws.register(on_visibility_changed, events.SceneItemVisibilityChanged)
 
         self.ws.connect()
-        device.send_text_for("title", "OBS", inverted=True) #Title
+        await device.send_text_for("title", "OBS", inverted=True) #Title
 
         ### Buttons 2 to 5 set different scenes (Moderation, Closeup, Slides and Video Mute) ###
         for scene in self.scenes:
-            device.assign_key(KeyCode["SW"+str(scene["button"])+"_PRESS"], [])
-            device.assign_key(KeyCode["SW"+str(scene["button"])+"_RELEASE"], [])
-            device.register_callback(self.getSetSceneCallback(scene["name"]), KeyCode["SW"+str(scene["button"])+"_PRESS"])
+            press = _PRESS_CODES[scene["button"]]
+            device.assign_key(press, _NO_EVENT)
+            device.assign_key(_RELEASE_CODES[scene["button"]], _NO_EVENT)
+            device.register_callback(self.getSetSceneCallback(scene["name"]), press)
 
 
 
         ### Button 6: Order!
-        def stopOrder():
-            self.ws.call(requests.SetSceneItemProperties("Order", visible=False))
-
-        def playOrder():
-            self.ws.call(requests.SetSceneItemProperties("Order", visible=True))
-            Timer(3, stopOrder).start()
-
-
-        device.assign_key(KeyCode["SW6_PRESS"], [])
-        device.assign_key(KeyCode["SW6_RELEASE"], [])
-        device.register_callback(playOrder, KeyCode["SW6_PRESS"])
-        device.send_icon_for(6, "icons/megaphone.png", centered=True)
+        # These requests never change. They can be sent repeatedly, as OBS calls are made one after another.
+        self.orderShow = requests.SetSceneItemProperties("Order", visible=True)
+        self.orderHide = requests.SetSceneItemProperties("Order", visible=False)
+        device.assign_key(_PRESS_CODES[6], _NO_EVENT)
+        device.assign_key(_RELEASE_CODES[6], _NO_EVENT)
+        device.register_callback(self.playOrder, _PRESS_CODES[6])
+        await device.send_icon_for(6, "icons/megaphone.png", centered=True)
 
 
         ### Buttons 7 to 9 toogle the visibility of items, some of which are present in multiple scenes (Mics, Picture-In-Picture cam, Video stream from phone) ###
         for state in self.states:
-            device.assign_key(KeyCode["SW"+str(state["button"])+"_PRESS"], [])
-            device.assign_key(KeyCode["SW"+str(state["button"])+"_RELEASE"], [])
-            device.register_callback(self.getToggleStateCallback(state), KeyCode["SW"+str(state["button"])+"_PRESS"])
+            press = _PRESS_CODES[state["button"]]
+            device.assign_key(press, _NO_EVENT)
+            device.assign_key(_RELEASE_CODES[state["button"]], _NO_EVENT)
+            device.register_callback(self.getToggleStateCallback(state), press)
 
         ### Get current state and initialize buttons accordingly ###
-        current = self.ws.call(requests.GetSceneList())
+        current = await loop.run_in_executor(self.obsCalls, self.ws.call, requests.GetSceneList())
         for scene in current.getScenes():
             for item in scene["sources"]:
-                for state in self.states:
-                    if (scene["name"], item["name"]) in state["items"]:
-                        state["current"] = item["render"]
+                for state in self.statesByItem.get((scene["name"], item["name"]), ()):
+                    state["current"] = item["render"]
 
         #Call updateSceneButtons and updateStateButtons to initialize their images
         self.currentScene = None
-        self.updateSceneButtons(device, current.getCurrentScene(), init=True)
-        self.updateStateButtons(device, None, None, True, init=True)
-        device.update_display()
+        await self.updateSceneButtons(device, current.getCurrentScene(), init=True)
+        await self.updateStateButtons(device, None, None, True, init=True)
+        await device.update_display()
         self.updateLED(device)
 
+    def deactivate(self, device):
+        self.cancelDisplayUpdate()
+        if self.updateTask is not None:
+            self.updateTask.cancel()
+        # Hide the "Order" source right away, its scheduled end would come after the connection is closed
+        if self.orderHandle is not None:
+            self.orderHandle.cancel()
+            self.stopOrder()
+        # The connection is opened again on activation. Closing it stops the events, after any request still being sent.
+        if self.ws is not None:
+            self.obsCalls.submit(self.ws.disconnect)
+            self.ws = None
+        super().deactivate(device)
+
     def animate(self, device):
         pass    #In this mode we want permanent LED illumination. Do not fade or animate otherwise.
@@ -5,9 +5,35 @@ Specialized class to handle MQTT communication.
 This class is used by the main controller to communicate with an MQTT server.
 '''
 
-import json
+import asyncio
+import socket
+import traceback
 # pylint: disable=import-error
 import paho.mqtt.client as mqtt
+try:
+    from orjson import loads as json_loads     # Faster JSON parser if available, pip3 install orjson
+except ImportError:
+    from json import loads as json_loads
+
+LIGHTS_MQTT_TOPIC = "zigbee2mqtt_octopi/plug_office"
+CO2_MQTT_TOPIC = "co2/data/update"
+# Topics and their QoS, all subscribed to with a single request
+_SUBSCRIPTIONS = [(LIGHTS_MQTT_TOPIC, 0), (CO2_MQTT_TOPIC, 0)]
+
+# Fixed requests to the lights, so they do not have to be assembled for every publish
+_LIGHTS_GET_TOPIC = LIGHTS_MQTT_TOPIC + "/get"
+_LIGHTS_SET_TOPIC = LIGHTS_MQTT_TOPIC + "/set"
+_LIGHTS_GET = b'{"state":""}'
+_LIGHTS_ON = b'{"state":"ON"}'
+_LIGHTS_OFF = b'{"state":"OFF"}'
+
+def _report_exception(future):
+    '''
+    Print the traceback of an exception raised by a callback, as nobody waits for its result.
+    '''
+    if not future.cancelled() and future.exception() is not None:
+        exc = future.exception()
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
 
 class InkkeysMqtt:
     '''
@@ -16,40 +42,68 @@ class InkkeysMqtt:
     def __init__(self, server, debug=False):
         self.server = server
         self.debug = debug
-
-        def on_message(client, userdata, message):
-            if message.topic == self.lights_mqtt_topic:
-                state = json.loads(str(message.payload.decode("utf-8")))
-                self.is_lights_on = state["state"] != "OFF"
-                if self.debug:
-                    print("Light: " + str(self.is_lights_on))
-            elif message.topic == self.co2_mqtt_topic:
-                state = json.loads(str(message.payload.decode("utf-8")))
-                self.co2 = state["co2"]
-                if self.debug:
-                    print("CO2: " + str(self.co2))
+        self.lights_callback = None     # Coroutine function called with the new state when the lights change
+        self.co2_callback = None        # Coroutine function called with the new level when the CO2 level changes
+        self.loop = None                # Event loop the callbacks are run on
+        # Without a server the states stay unknown (None)
+        self.is_lights_on = None
+        self.co2 = None
 
         if self.server is not None:
-            self.client = mqtt.Client("inkkeys")
-            self.client.on_message = on_message
+            # A persistent session keeps the subscriptions on the server while the connection is briefly lost
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="inkkeys", clean_session=False)
+            self.client.reconnect_delay_set(min_delay=1, max_delay=8)
+            self.client.on_connect = self._on_connect
+            # The client routes each message to the callback of its topic
+            self.client.message_callback_add(LIGHTS_MQTT_TOPIC, self._on_lights_message)
+            self.client.message_callback_add(CO2_MQTT_TOPIC, self._on_co2_message)
 
             self.is_lights_on = False
-            self.lights_mqtt_topic = "zigbee2mqtt_octopi/plug_office"
-
             self.co2 = 0
-            self.co2_mqtt_topic = "co2/data/update"
+
+    # This is called whenever the connection to the server is (re-)established
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            return
+        # The messages are tiny, so send them right away instead of waiting to coalesce them (Nagle's algorithm)
+        try:
+            client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass    # Not a plain TCP socket (e.g. websockets) or already closed again
+        if not flags.session_present:
+            client.subscribe(_SUBSCRIPTIONS)
+        # Messages may have been missed while disconnected, so ask for the current state again
+        client.publish(_LIGHTS_GET_TOPIC, _LIGHTS_GET)
+
+    # This is called from the thread of the MQTT client
+    def _on_lights_message(self, client, userdata, message):
+        state = json_loads(message.payload)     # Both parsers accept the UTF-8 encoded bytes directly
+        is_lights_on = state["state"] != "OFF"
+        if self.debug:
+            print("Light: " + str(is_lights_on))
+        if is_lights_on != self.is_lights_on:
+            self.is_lights_on = is_lights_on
+            self.notify(self.lights_callback, is_lights_on)
+
+    # This is called from the thread of the MQTT client
+    def _on_co2_message(self, client, userdata, message):
+        state = json_loads(message.payload)
+        co2 = state["co2"]
+        if self.debug:
+            print("CO2: " + str(co2))
+        if co2 != self.co2:
+            self.co2 = co2
+            self.notify(self.co2_callback, co2)
 
     def connect(self):
         '''
-        Connect to the MQTT server and subscribe to the topics.
+        Connect to the MQTT server. The topics are subscribed to once the connection is established.
+        The client reconnects by itself if the connection is lost.
         '''
         if self.server is None:
             return
         self.client.connect(self.server)
         self.client.loop_start()
-        self.client.subscribe(self.lights_mqtt_topic)
-        self.client.subscribe(self.co2_mqtt_topic)
-        self.client.publish(self.lights_mqtt_topic + "/get",'{"state":""}')
 
     def disconnect(self):
         '''
@@ -67,16 +121,39 @@ class InkkeysMqtt:
         '''
         if self.server is None:
             return
-        self.client.publish(self.lights_mqtt_topic + "/set",'{"state":' + ('"ON"' if state else '"OFF"') + '}')
+        self.client.publish(_LIGHTS_SET_TOPIC, _LIGHTS_ON if state else _LIGHTS_OFF)
+
+    def on_lights_change(self, callback):
+        '''
+        Register a coroutine function to be called with the new state whenever the lights are switched.
+        It runs on the event loop of the caller. None removes the callback.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.lights_callback = callback
+
+    def on_co2_change(self, callback):
+        '''
+        Register a coroutine function to be called with the new level whenever the CO2 level changes.
+        It runs on the event loop of the caller. None removes the callback.
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.co2_callback = callback
+
+    def notify(self, callback, value):
+        '''
+        Hand a change over from the thread of the MQTT client to the event loop.
+        '''
+        if callback is not None and self.loop is not None and not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(callback(value), self.loop).add_done_callback(_report_exception)
 
     def get_lights(self):
         '''
         Get the state of the lights.
         '''
-        return self.is_lights_on if self.server is not None else None
+        return self.is_lights_on
 
     def get_co2(self):
         ''''
         Get the CO2 level.
         '''
-        return self.co2 if self.server is not None else None
+        return self.co2
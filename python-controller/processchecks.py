@@ -4,15 +4,20 @@
 This file contains functions to get the names of active processes and the active window.
 '''
 
+import os
 import sys
 import psutil
 
 # pylint: disable=import-error
 if sys.platform in ['linux', 'linux2']:
-    import Xlib
     import Xlib.display
+    from Xlib.X import AnyPropertyType, PropertyChangeMask, PropertyNotify
     display = Xlib.display.Display()
     root = display.screen().root
+    # Interning an atom is a round trip to the X server, so it is only done once
+    active_window_atom = display.intern_atom('_NET_ACTIVE_WINDOW')
+    # Let the X server report changes of the active window instead of asking for it every time
+    root.change_attributes(event_mask=PropertyChangeMask)
 elif sys.platform in ['Windows', 'win32', 'cygwin']:
     import win32gui
 elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
@@ -20,11 +25,84 @@ elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
 else:
     print("Unknown platform: " + sys.platform)
 
+# Names of the running processes by their PID, so psutil is only asked about processes that are new or have changed
+_process_names = {}
+# Set of the names returned last, the same object is returned again as long as the names do not change
+_process_set = frozenset()
+
+# Window class of the active window on Linux, only read again after the X server reported a change
+_active_window_class = None
+_active_window_changed = True
+
+def _read_comm(pid):
+    '''
+    Read the name of a process from /proc on Linux, as the kernel cuts it off at 15 characters.
+    Returns None if it cannot be read.
+    '''
+    try:
+        with open(f"/proc/{pid}/comm", "rb") as comm:
+            return os.fsdecode(comm.read().rstrip(b"\n"))
+    except OSError:
+        return None
+
+def _get_process_name(pid, comm=None):
+    '''
+    Get the full name of a single process, using its name from /proc if that is complete.
+    '''
+    # The kernel cuts names off at 15 characters, psutil completes those from the command line
+    if comm is not None and len(comm) < 15:
+        return comm
+    return psutil.Process(pid).name()
+
 def get_active_processes():
     '''
     Get the names of all running processes.
+    The result is a frozenset, which is the identical object as long as no name was added, removed or changed.
+    On Linux the name of each known process is checked again, as it changes when the process executes another program.
+    '''
+    global _process_set
+    is_linux = sys.platform in ['linux', 'linux2']
+    pids = psutil.pids()
+    changed = False
+    for pid in _process_names.keys() - set(pids):
+        del _process_names[pid]
+        changed = True
+    for pid in pids:
+        known = _process_names.get(pid)
+        if known is not None and not is_linux:
+            continue    # Checking the name again would mean asking psutil about every process
+        comm = _read_comm(pid) if is_linux else None
+        if known is not None and (comm is None or comm == known[:15]):
+            continue    # Unchanged, or the process has just ended and is removed with the next check
+        try:
+            name = _get_process_name(pid, comm)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue    # The process has ended in the meantime or cannot be inspected
+        if name != known:
+            _process_names[pid] = name
+            changed = True
+    if changed:
+        names = frozenset(_process_names.values())
+        if names != _process_set:
+            _process_set = names
+    return _process_set
+
+def _get_active_window_class():
+    '''
+    Get the window class of the active window on Linux.
+    Pending events are handled without blocking and the window is only looked up if it might have changed.
     '''
-    return {p.name() for p in psutil.process_iter(["name"])}
+    global _active_window_class, _active_window_changed
+    while display.pending_events():
+        event = display.next_event()
+        if event.type == PropertyNotify and event.atom == active_window_atom:
+            _active_window_changed = True
+    if _active_window_changed:
+        window_id = root.get_full_property(active_window_atom, AnyPropertyType).value[0]
+        window = display.create_resource_object('window', window_id)
+        _active_window_class = window.get_wm_class()[0]
+        _active_window_changed = False  # Only after success, so a failed lookup is retried on the next call
+    return _active_window_class
 
 # Adapted from Martin Thoma on stackoverflow
 # https://stackoverflow.com/a/36419702/8068814
@@ -35,12 +113,12 @@ def get_active_window():
     active_window_name = None
     try:
         if sys.platform in ['linux', 'linux2']:
-            window_id = root.get_full_property(display.intern_atom('_NET_ACTIVE_WINDOW'), Xlib.X.AnyPropertyType).value[0]
-            window = display.create_resource_object('window', window_id)
-            return window.get_wm_class()[0]
+            return _get_active_window_class()
         if sys.platform in ['Windows', 'win32', 'cygwin']:
             window = win32gui.GetForegroundWindow()
-            active_window_name = win32gui.GetWindowText(window)
+            # There is no foreground window while the focus changes, the last known one stays valid then
+            if window:
+                active_window_name = win32gui.GetWindowText(window)
         elif sys.platform in ['Mac', 'darwin', 'os2', 'os2emx']:
             active_window_name = NSWorkspace.sharedWorkspace().activeApplication()['NSApplicationName']
     except Exception: